@@ -5,6 +5,9 @@ install_requires = ['setuptools', 'relstorage >=2.1a2', 'newt.db >=0.5.1']
 extras_require = dict(test=['manuel', 'mock', 'zope.testing'])
 
 entry_points = """
+[console_scripts]
+newt-qbe-indexes = newt.qbe.indexes:main
+newt-qbe-benchmark = newt.qbe.benchmark:main
 """
 
 from setuptools import setup
@@ -1,39 +1,159 @@
+import base64
+import collections
 import contextlib
+import datetime
+import itertools
 import json
-from newt.db.search import read_only_cursor
+from newt.db.search import _storage, read_only_cursor
 import re
 import six
+from timeit import default_timer as _timer
+from ZODB.utils import p64
+
+from . import literal
+from ._lru import LRU
+from .literal import placeholder
+from .prepared import execute
 
 
 is_identifier = re.compile(r'\w+$').match
 is_access = re.compile(r"state\s*(->\s*(\d+|'\w+')\s*)+$").match
 is_paranthesized = re.compile("\w*[(].+[)]$").match
+is_json_field = re.compile(r"[(]state -> u?'\w+'[)]$").match
+is_time_type = re.compile(
+    r"\s*(date|time|timetz|timestamp|timestamptz|interval)\b", re.I).match
+
+def has_placeholder(sql):
+    if isinstance(sql, bytes):
+        sql = sql.decode('utf-8')
+    return '%s' in sql.replace('%%', '')
 
 class Convertible(object):
 
     def convert(self, v):
         return v
 
+    def shape(self, query):
+        return None
+
+    def __call__(self, cursor, query):
+        return cursor.mogrify(self.template(query), self.params(query))
+
 class match(Convertible):
 
-    def __init__(self, name, convert=None):
+    member = False
+
+    def __init__(self, name, convert=None, member=False):
         self.name = name
+        self.member = member
         if convert is not None:
             self.convert = convert
 
-    def __call__(self, cursor, query):
-        query = self.convert(query)
-        return cursor.mogrify('(state @> %s::jsonb)',
-                              (json.dumps({self.name: query}),))
+    @property
+    def path(self):
+        name = self.name
+        return tuple(name) if isinstance(name, (tuple, list)) else (name,)
+
+    def template(self, query):
+        return '(state @> %s::jsonb)'
+
+    def document(self, query):
+        value = self.convert(query)
+        if self.member and not isinstance(value, list):
+            value = [value]
+        for key in reversed(self.path):
+            value = {key: value}
+        return value
+
+    def params(self, query):
+        return (json.dumps(self.document(query)),)
+
+def _merge(target, document):
+    for key, value in document.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+class _Containment(object):
+    """Merge the documents of several ``match`` helpers
+
+    The merged document is used in a single containment condition, so
+    it can be checked with a single JSON GIN index lookup.
+    """
+
+    def __init__(self):
+        self.helpers = []
+
+    def accepts(self, path):
+        # Documents for overlapping paths can't be merged.
+        return not any(path[:len(helper.path)] == helper.path[:len(path)]
+                       for _, helper in self.helpers)
+
+    def __call__(self, query):
+        document = collections.OrderedDict()
+        for name, helper in self.helpers:
+            _merge(document, helper.document(query[name]))
+        return (json.dumps(document),)
 
 class Search(Convertible):
 
+    scope = None
+    column = None
+
+    def _scoped(self, sql):
+        # Make indexes partial if the helper has a scope.
+        if self.scope:
+            sql += ' WHERE ' + self.scope
+        return sql
+
+    def column_sql(self):
+        if not self.column:
+            return []
+        d = dict(column=self.column, source=self.source,
+                 type=self.column_type)
+        return [
+            "ALTER TABLE newt ADD COLUMN IF NOT EXISTS %(column)s %(type)s"
+            % d,
+            "CREATE OR REPLACE FUNCTION newt_%(column)s_update()"
+            " RETURNS trigger AS $$\n"
+            "BEGIN\n"
+            "  NEW.%(column)s := (\n"
+            "    SELECT %(source)s FROM (SELECT NEW.state) AS newt(state));\n"
+            "  RETURN NEW;\n"
+            "END\n"
+            "$$ LANGUAGE plpgsql" % d,
+            "DROP TRIGGER IF EXISTS newt_%(column)s_trigger ON newt" % d,
+            "CREATE TRIGGER newt_%(column)s_trigger"
+            " BEFORE INSERT OR UPDATE OF state ON newt"
+            " FOR EACH ROW EXECUTE PROCEDURE newt_%(column)s_update()" % d,
+            ]
+
+    def backfill_sql(self):
+        if self.column:
+            return (
+                "WITH batch AS (\n"
+                "  SELECT zoid FROM newt WHERE zoid > %%s"
+                " ORDER BY zoid LIMIT %%s)\n"
+                "UPDATE newt SET %s = %s\n"
+                "FROM batch WHERE newt.zoid = batch.zoid\n"
+                "RETURNING newt.zoid" % (
+                    self.column, self.source.replace('%', '%%')))
+
     def order_by(self, cursor, query):
         return self.expr.encode('ascii')
 
+    def order_template(self, query):
+        return self.expr.replace('%', '%%')
+
+    def order_params(self, query):
+        return ()
+
 class scalar(Search):
 
-    def __init__(self, expr, type=None, convert=None):
+    def __init__(self, expr, type=None, convert=None, scope=None,
+                 column=None):
         if is_identifier(expr):
             expr = 'state ->> %r' % expr
 
@@ -46,7 +166,15 @@ class scalar(Search):
         if type:
             expr = '%s::%s' % (expr, type)
 
+        self.column = column
+        if column:
+            # Search using a stored value, which indexes can cover
+            self.source = expr
+            self.column_type = type or 'text'
+            expr = column
+
         self.expr = expr
+        self.scope = scope
         d = dict(expr=expr)
         self._range = '((%(expr)s >= %%s) and (%(expr)s <= %%s))' % d
         self._eq =    '(%(expr)s = %%s)'                          % d
@@ -56,54 +184,180 @@ class scalar(Search):
         if convert is not None:
             self.convert = convert
 
-    def __call__(self, cursor, query):
+    def shape(self, query):
+        if not isinstance(query, tuple):
+            return 'eq'
+
+        min, max = query
+        if min is None:
+            return 'le'
+        elif max is None:
+            return 'ge'
+        else:
+            return 'range'
+
+    def template(self, query):
+        return getattr(self, '_' + self.shape(query))
+
+    def params(self, query):
         if not isinstance(query, tuple):
-            return cursor.mogrify(self._eq, (self.convert(query),))
+            return (self.convert(query),)
 
         min, max = query
         if min is None:
-            max = self.convert(max)
-            return cursor.mogrify(self._le, (max,))
+            return (self.convert(max),)
         elif max is None:
-            min = self.convert(min)
-            return cursor.mogrify(self._ge, (min,))
+            return (self.convert(min),)
         else:
-            min = self.convert(min)
-            max = self.convert(max)
-            return cursor.mogrify(self._range, (min, max))
+            return (self.convert(min), self.convert(max))
+
+    def any_template(self, values):
+        return '(%s = ANY(%%s))' % self.expr
+
+    def any_params(self, values):
+        return ([self.convert(v) for v in values],)
 
     def index_sql(self, name):
         expr = self.expr
+        if not (is_paranthesized(expr) or is_identifier(expr)):
+            expr = '(' + expr + ')'
+        return self._scoped(
+            "CREATE INDEX CONCURRENTLY newt_%s_idx ON newt (%s)" % (
+                name, expr))
+
+class span(Search):
+
+    def __init__(self, expr, type='numeric', index='btree', bucket=None,
+                 convert=None, scope=None, column=None):
+        if is_identifier(expr):
+            expr = 'state ->> %r' % expr
+
+        if is_access(expr):
+            expr = '>>'.join(expr.rsplit('>', 1))
+
         if not is_paranthesized(expr):
             expr = '(' + expr + ')'
-        return "CREATE INDEX CONCURRENTLY newt_%s_idx ON newt (%s)" % (
-            name, expr)
+
+        expr = '%s::%s' % (expr, type)
+
+        if index not in ('btree', 'brin'):
+            raise ValueError("Invalid span index type", index)
+
+        self.type = type
+        self.column = column
+        if column:
+            self.source = expr
+            self.column_type = type
+            expr = column
+
+        self.expr = expr
+        self.index = index
+        self.scope = scope
+
+        # Facets count times by date_trunc fields and numbers by width.
+        self.bucket = bucket
+        if bucket is None:
+            self.bucket_expr = None
+        elif isinstance(bucket, str):
+            self.bucket_expr = "date_trunc('%s', %s)" % (bucket, expr)
+        else:
+            self.bucket_expr = '(floor(%s / %r::numeric) * %r)' % (
+                expr, bucket, bucket)
+
+        if convert is not None:
+            self.convert = convert
+
+    def _bounds(self, query):
+        if isinstance(query, datetime.timedelta):
+            query = query, None # Relative to now
+        return query
+
+    def shape(self, query):
+        query = self._bounds(query)
+        if not isinstance(query, tuple):
+            return 'eq'
+        return tuple(None if v is None else
+                     'ago' if isinstance(v, datetime.timedelta) else
+                     'value'
+                     for v in query)
+
+    def template(self, query):
+        shape = self.shape(query)
+        if shape == 'eq':
+            return '(%s = %%s)' % self.expr
+
+        conditions = []
+        for kind, op in zip(shape, ('>=', '<')):
+            if kind == 'ago':
+                # Intervals are passed as text, so they're cast once.
+                conditions.append('(%s %s now() - %%s::interval)' % (
+                    self.expr, op))
+            elif kind == 'value':
+                conditions.append('(%s %s %%s)' % (self.expr, op))
+        if len(conditions) == 1:
+            return conditions[0]
+        return '(%s)' % ' and '.join(conditions) if conditions else 'true'
+
+    def params(self, query):
+        query = self._bounds(query)
+        if not isinstance(query, tuple):
+            return (self.convert(query),)
+        return tuple(literal.interval(v) if isinstance(v, datetime.timedelta)
+                     else self.convert(v)
+                     for v in query if v is not None)
+
+    @property
+    def indexable(self):
+        # Converting text to times isn't immutable, so time expressions
+        # can't be indexed, but stored times can.
+        return bool(self.column) or not is_time_type(self.type)
+
+    def index_sql(self, name):
+        if not self.indexable:
+            raise ValueError(
+                "Times can only be indexed if stored, using the column"
+                " option", name)
+        expr = self.expr
+        if not (is_paranthesized(expr) or is_identifier(expr)):
+            expr = '(' + expr + ')'
+        return self._scoped(
+            "CREATE INDEX CONCURRENTLY newt_%s_idx ON newt %s(%s)" % (
+                name, 'USING BRIN ' if self.index == 'brin' else '', expr))
 
 class text_array(Search):
 
-    def __init__(self, expr, convert=None):
+    def __init__(self, expr, convert=None, scope=None):
         if is_identifier(expr):
             expr = "(state -> %r)" % expr
         elif not is_paranthesized(expr):
             expr = '(' + expr + ')'
 
         self.expr = expr
+        self.scope = scope
         self._any = self.expr + ' && %s'
 
         if convert is not None:
             self.convert = convert
 
-    def __call__(self, cursor, query):
-        query = self.convert(query)
-        return cursor.mogrify(self._any, (query,))
+    @property
+    def json(self):
+        # JSON arrays, rather than PostgreSQL arrays
+        return bool(is_json_field(self.expr))
+
+    def template(self, query):
+        return self._any
+
+    def params(self, query):
+        return (self.convert(query),)
 
     def index_sql(self, name):
-        return ("CREATE INDEX CONCURRENTLY newt_%s_idx ON newt USING GIN (%s)" %
-                (name, self.expr))
+        return self._scoped(
+            "CREATE INDEX CONCURRENTLY newt_%s_idx ON newt USING GIN (%s)" %
+            (name, self.expr))
 
 class prefix(Search):
 
-    def __init__(self, expr, delimiter=None, convert=None):
+    def __init__(self, expr, delimiter=None, convert=None, scope=None):
         if is_identifier(expr):
             expr = 'state -> %r' % expr
 
@@ -116,28 +370,169 @@ class prefix(Search):
             expr = '(' + expr + ')'
 
         self.expr = expr
+        self.scope = scope
 
         self._like = "(%s like %%s || '%s%%%%')" % (expr, delimiter or '')
 
         if convert is not None:
             self.convert = convert
 
-    def __call__(self, cursor, query):
-        query = self.convert(query)
-        return cursor.mogrify(self._like, (query,))
+    def template(self, query):
+        return self._like
+
+    def params(self, query):
+        return (self.convert(query),)
 
     def index_sql(self, name):
-        return (
+        return self._scoped(
             "CREATE INDEX CONCURRENTLY newt_%s_idx"
             " ON newt (%s text_pattern_ops)" %
             (name, self.expr))
 
+class path(Search):
+
+    def __init__(self, expr, column, delimiter='/', convert=None, scope=None):
+        if is_identifier(expr):
+            expr = 'state -> %r' % expr
+
+        if is_access(expr):
+            expr = '>>'.join(expr.rsplit('>', 1))
+
+        if not is_paranthesized(expr):
+            expr = '(' + expr + ')'
+
+        # Paths are stored as arrays of ancestor paths, including the
+        # path itself, in a column with a GIN index.
+        d = dict(expr=expr, column=column,
+                 delimiter=delimiter.replace("'", "''"))
+        self.source = (
+            "CASE WHEN %(expr)s IS NULL THEN NULL ELSE array(\n"
+            "  SELECT '%(delimiter)s' ||"
+            " array_to_string(s[1:n], '%(delimiter)s')\n"
+            "  FROM (SELECT array_remove(string_to_array("
+            "%(expr)s, '%(delimiter)s'), '') AS s) segments,\n"
+            "       generate_series(1, cardinality(s)) n\n"
+            "  ORDER BY n) END" % d)
+        self.column = self.expr = column
+        self.column_type = 'text[]'
+        self.delimiter = delimiter
+        self.scope = scope
+
+        self._templates = dict(
+            all='(%(column)s IS NOT NULL)' % d,
+            under='(%(column)s @> ARRAY[%%s])' % d,
+            depth='(%(column)s IS NOT NULL AND'
+                  ' cardinality(%(column)s) = %%s)' % d,
+            under_depth='(%(column)s @> ARRAY[%%s] AND'
+                        ' cardinality(%(column)s) = %%s)' % d,
+            ancestors='(%(column)s <@ %%s::text[] AND'
+                      ' cardinality(%(column)s) > 0)' % d,
+            )
+
+        if convert is not None:
+            self.convert = convert
+
+    def _query(self, query):
+        if not isinstance(query, dict):
+            query = dict(under=query)
+        if not (set(query) in ({'under'}, {'under', 'depth'}, {'ancestors'})):
+            raise ValueError("Invalid path query", query)
+        return query
+
+    def _prefixes(self, value):
+        delimiter = self.delimiter
+        segments = [s for s in self.convert(value).split(delimiter) if s]
+        return [delimiter + delimiter.join(segments[:i + 1])
+                for i in range(len(segments))]
+
+    def shape(self, query):
+        query = self._query(query)
+        if 'ancestors' in query:
+            return 'ancestors'
+        shape = 'under' if self._prefixes(query['under']) else 'all'
+        if query.get('depth') is not None:
+            shape = 'under_depth' if shape == 'under' else 'depth'
+        return shape
+
+    def template(self, query):
+        return self._templates[self.shape(query)]
+
+    def params(self, query):
+        query = self._query(query)
+        if 'ancestors' in query:
+            return (self._prefixes(query['ancestors'])[:-1],)
+        prefixes = self._prefixes(query['under'])
+        params = prefixes[-1:]
+        if query.get('depth') is not None:
+            params.append(len(prefixes) + query['depth'])
+        return tuple(params)
+
+    def index_sql(self, name):
+        return self._scoped(
+            "CREATE INDEX CONCURRENTLY newt_%s_idx ON newt USING GIN (%s)" %
+            (name, self.column))
+
+class trigram(Search):
+
+    def __init__(self, expr, similar=False, index='gin', convert=None,
+                 scope=None):
+        if is_identifier(expr):
+            expr = 'state ->> %r' % expr
+
+        if is_access(expr):
+            expr = '>>'.join(expr.rsplit('>', 1))
+
+        if not is_paranthesized(expr):
+            expr = '(' + expr + ')'
+
+        if index not in ('gin', 'gist'):
+            raise ValueError("Invalid trigram index type", index)
+
+        self.expr = expr
+        self.similar = similar
+        self.index = index
+        self.scope = scope
+        escaped = expr.replace('%', '%%')
+        self._search = '(%s %s %%s)' % (escaped, '%%' if similar else 'ilike')
+        self._order = escaped + ' <-> %s'
+
+        if convert is not None:
+            self.convert = convert
+
+    def template(self, query):
+        return self._search
+
+    def params(self, query):
+        query = self.convert(query)
+        if not self.similar:
+            # Match the query text literally, anywhere
+            query = '%' + (query.replace('\\', '\\\\')
+                           .replace('%', '\\%').replace('_', '\\_')) + '%'
+        return (query,)
+
+    def order_by(self, cursor, query):
+        return cursor.mogrify(self._order, self.order_params(query))
+
+    def order_template(self, query):
+        return self._order
+
+    def order_params(self, query):
+        return (self.convert(query),)
+
+    def index_sql(self, name):
+        return self._scoped(
+            "CREATE INDEX CONCURRENTLY newt_%s_idx ON newt USING %s"
+            " (%s %s_trgm_ops)" % (name, self.index.upper(), self.expr,
+                                   self.index))
+
 class fulltext(Search):
 
     def __init__(self, expr, config,
                  parser=None,
                  weights=(.1, .2, .4, 1.0),
-                 convert=None
+                 convert=None,
+                 scope=None,
+                 column=None,
                  ):
         if is_identifier(expr):
             expr = "state -> %r" % expr
@@ -150,6 +545,13 @@ class fulltext(Search):
         elif not is_paranthesized(expr):
             expr = '(' + expr + ')'
 
+        self.column = column
+        if column:
+            # Search and rank using a stored vector
+            self.source = expr
+            self.column_type = 'tsvector'
+            expr = column
+
         self.expr = expr
 
         self._search = "%s @@ to_tsquery(%s%%s)" % (expr, config)
@@ -160,22 +562,29 @@ class fulltext(Search):
 
         self.parser = parser
         self.weights = weights
+        self.scope = scope
 
         if convert is not None:
             self.convert = convert
 
-    def __call__(self, cursor, query):
+    def template(self, query):
+        return self._search
+
+    def params(self, query):
         if self.parser is not None:
             query = self.parser(query)
-        return cursor.mogrify(self._search, (query,))
+        return (query,)
 
     def order_by(self, cursor, query):
-        if self.parser is not None:
-            query = self.parser(query)
-        return cursor.mogrify(self._order, (query,))
+        return cursor.mogrify(self._order, self.order_params(query))
+
+    def order_template(self, query):
+        return self._order
+
+    order_params = params
 
     def index_sql(self, name):
-        return (
+        return self._scoped(
             "CREATE INDEX CONCURRENTLY newt_%s_idx ON newt USING GIN (%s)" %
             (name, self.expr))
 
@@ -188,48 +597,1178 @@ class sql(Convertible):
         if convert is not None:
             self.convert = convert
 
-    def __call__(self, cursor, query):
-        query = self.convert(query)
-        return cursor.mogrify(self.cond, (query,))
+    def template(self, query):
+        return self.cond
+
+    def params(self, query):
+        if has_placeholder(self.cond):
+            return (self.convert(query),)
+        return ()
 
     def order_by(self, cursor, query):
         if self.order:
-            return cursor.mogrify(self.order, (query,))
+            return cursor.mogrify(self.order, self.order_params(query))
+
+    def order_template(self, query):
+        return self.order
+
+    def order_params(self, query):
+        if has_placeholder(self.order):
+            return (query,)
+        return ()
+
+def _bytes(sql):
+    return sql if isinstance(sql, bytes) else sql.encode('utf-8')
+
+class _Raw(object):
+    """SQL rendered by a helper that doesn't provide a template
+    """
+
+    def __init__(self, sql):
+        self.sql = sql
+
+    def __conform__(self, protocol):
+        return self
+
+    def getquoted(self):
+        return self.sql
+
+_PARAMS, _RAW, _EXTRA, _QUERY = range(4)
+
+class _Plan(object):
+    """Compiled SQL for a query shape
+
+    The template has a placeholder for each parameter.  Parameters are
+    computed by binders, which are ``(kind, key, function)`` tuples.
+    ``_PARAMS`` binders are helper methods that return parameters for
+    query data.  ``_RAW`` binders are helper methods that need a cursor
+    and return rendered SQL.  ``_EXTRA`` binders take the parameter at
+    the given index from extra data passed when binding.  ``_QUERY``
+    binders are functions that return parameters for the whole query.
+
+    Query data are looked up by key in the mapping returned by the
+    bindings function for a query.  For criteria mappings, keys are
+    helper names.
+    """
+
+    def __init__(self, template, binders, bindings=None):
+        self.template = template
+        self.fragments = literal.split(template)
+        self.binders = binders
+        self.bindings = bindings
+        self.raw = any(kind == _RAW for kind, _, _ in binders)
+
+    def bind(self, cursor, query, extra=()):
+        if self.bindings is not None:
+            query = self.bindings(query)
+        params = []
+        for kind, name, f in self.binders:
+            if kind == _PARAMS:
+                params.extend(f(query.get(name)))
+            elif kind == _RAW:
+                params.append(_Raw(f(cursor, query.get(name))))
+            elif kind == _QUERY:
+                params.extend(f(query))
+            else:
+                params.append(extra[name])
+        return params
+
+    def render(self, cursor, query, extra=()):
+        """Return a template and parameters for a query
+
+        Raw SQL from helpers without templates is included in the
+        returned template.
+        """
+        params = self.bind(cursor, query, extra)
+        if not self.raw:
+            return self.template, params
+
+        params = iter(params)
+        bound = []
+        def sub(m):
+            if m.group() == b'%%':
+                return b'%%'
+            param = next(params)
+            if isinstance(param, _Raw):
+                return param.sql.replace(b'%', b'%%')
+            bound.append(param)
+            return b'%s'
+
+        return placeholder.sub(sub, self.template), bound
+
+def _defined(helper, name):
+    # The position, in the helper's class' MRO, of the class defining
+    # an attribute
+    mro = type(helper).__mro__
+    for i, cls in enumerate(mro):
+        if name in cls.__dict__:
+            return i
+    return len(mro)
+
+def _template(helper, name, method):
+    """Return a helper's template method, or None
+
+    Templates aren't used if the helper's class overrides the method
+    that renders SQL using a cursor, but not the template method, as
+    subclasses of built-in helpers might.
+    """
+    template = getattr(helper, name, None)
+    if template is not None and (_defined(helper, method) <
+                                 _defined(helper, name)):
+        return None
+    return template
+
+def _order_by(order_by):
+    if isinstance(order_by, str):
+        order_by = (order_by,)
+    return tuple((item, False) if isinstance(item, str)
+                 else (item[0], bool(item[1]))
+                 for item in order_by)
+
+# Plan forms combine a WHERE clause, given as SQL and binders, and
+# ordering, given as a sequence of (SQL, binders, descending) tuples.
+
+def _sql_form(where, orders):
+    sql, binders = where
+    binders = list(binders)
+    if orders:
+        sql += b'\nORDER BY ' + b',\n  '.join(
+            order + b' DESC' if desc else order
+            for order, _, desc in orders)
+        for _, order_binders, _ in orders:
+            binders.extend(order_binders)
+    return sql, binders
+
+def _search_form(where, orders):
+    sql, binders = _sql_form(where, orders)
+    return b'select zoid, ghost_pickle from newt where ' + sql, binders
+
+def _numbered_form(where, orders):
+    # Number results in search order, so results of several searches
+    # combined with UNION ALL can be put back in order.
+    order_sql, order_binders = _sql_form((b'', ()), orders)
+    sql, binders = where
+    return (b'select zoid, ghost_pickle, row_number() over (' +
+            order_sql.strip() + b')\nfrom newt where ' + sql,
+            order_binders + list(binders))
+
+def _zoids_form(where, orders):
+    sql, binders = _sql_form(where, orders)
+    return b'select zoid from newt where ' + sql, binders
+
+def _count_form(where, orders):
+    sql, binders = where
+    return b'select count(*) from newt where ' + sql, binders
+
+def _capped_count_form(where, orders):
+    sql, binders = where
+    return (b'select count(*) from (select 1 from newt where ' + sql +
+            b' LIMIT %s) _', list(binders) + [(_EXTRA, 0, None)])
+
+def _estimate_form(where, orders):
+    sql, binders = where
+    return b'EXPLAIN (FORMAT JSON) select 1 from newt where ' + sql, binders
+
+def _batch_form(where, orders):
+    sql, binders = _sql_form(where, orders)
+    return (b'select zoid, ghost_pickle, count(*) over ()\n'
+            b'from newt\nwhere ' + sql + b'\nOFFSET %s LIMIT %s',
+            binders + [(_EXTRA, 0, None), (_EXTRA, 1, None)])
+
+def _cte_batch_form(where, orders):
+    where_sql, binders = where
+    order_sql, order_binders = _sql_form((b'', ()), orders)
+    return (b'WITH matches AS (select * from newt where ' + where_sql +
+            b')\nselect zoid, ghost_pickle,'
+            b' (select count(*) from matches)\nfrom matches' + order_sql +
+            b'\nOFFSET %s LIMIT %s',
+            list(binders) + order_binders +
+            [(_EXTRA, 0, None), (_EXTRA, 1, None)])
+
+def _seek(keys):
+    """Compute a predicate for rows after those with the given keys
+
+    Key values are the extra parameters, in key order.
+    """
+    binders = []
+    descs = set(desc for _, _, desc in keys)
+    if len(descs) == 1:
+        binders.extend(b for _, key_binders, _ in keys for b in key_binders)
+        binders.extend((_EXTRA, i, None) for i in range(len(keys)))
+        sql = (b'(' + b', '.join(key for key, _, _ in keys) + b')' +
+               (b' < ' if descs.pop() else b' > ') +
+               b'(' + b', '.join([b'%s'] * len(keys)) + b')')
+        return sql, binders
+
+    sql = b''
+    for i, (key, key_binders, desc) in reversed(list(enumerate(keys))):
+        comparison = key + (b' < %s' if desc else b' > %s')
+        if sql:
+            sql = (b'(' + comparison + b' OR (' + key + b' = %s AND ' +
+                   sql + b'))')
+            binders[:0] = (list(key_binders) + [(_EXTRA, i, None)] +
+                           list(key_binders) + [(_EXTRA, i, None)])
+        else:
+            sql = comparison
+            binders[:0] = list(key_binders) + [(_EXTRA, i, None)]
+    return sql, binders
+
+def _page_form(where, orders, after=False):
+    descs = set(desc for _, _, desc in orders)
+    keys = list(orders) + [(b'zoid', (), len(descs) == 1 and descs.pop())]
+
+    binders = []
+    sql = b'select zoid, ghost_pickle'
+    for order, order_binders, _ in orders:
+        sql += b', (' + order + b')::text'
+        binders.extend(order_binders)
+
+    where_sql, where_binders = where
+    sql += b'\nfrom newt\nwhere ' + where_sql
+    binders.extend(where_binders)
+    if after:
+        seek, seek_binders = _seek(keys)
+        sql += b' AND\n  ' + seek
+        binders.extend(seek_binders)
+
+    order_sql, order_binders = _sql_form((b'', ()), keys)
+    sql += order_sql + b'\nLIMIT %s'
+    binders.extend(order_binders)
+    binders.append((_EXTRA, len(keys) if after else 0, None))
+    return sql, binders
+
+def _top_form(where, orders, proxies):
+    # Rank a limited number of candidates, chosen using the first
+    # (proxy) orderings, if any.
+    proxy_sql, proxy_binders = _sql_form(where, orders[:proxies])
+    order_sql, order_binders = _sql_form((b'', ()), orders[proxies:])
+    return (b'select zoid, ghost_pickle, count(*) over ()\n'
+            b'from (select * from newt where ' + proxy_sql +
+            b'\n      LIMIT %s) candidates' + order_sql + b'\nLIMIT %s',
+            proxy_binders + [(_EXTRA, 0, None)] + order_binders +
+            [(_EXTRA, 1, None)])
+
+_forms = dict(
+    sql=_sql_form,
+    search=_search_form,
+    numbered=_numbered_form,
+    zoids=_zoids_form,
+    count=_count_form,
+    batch=_batch_form,
+    cte_batch=_cte_batch_form,
+    capped=_capped_count_form,
+    estimate=_estimate_form,
+    page=_page_form,
+    page_after=lambda where, orders: _page_form(where, orders, True),
+    top=_top_form,
+    )
+
+class _Operation(object):
+
+    def __init__(self, *queries):
+        self.queries = queries
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join(repr(q) for q in self.queries))
+
+class And(_Operation):
+    """Combine queries, which must all be satisfied
+    """
+
+class Or(_Operation):
+    """Combine queries, at least one of which must be satisfied
+    """
+
+class Not(object):
+    """Negate a query
+    """
+
+    def __init__(self, query):
+        self.query = query
+
+    def __repr__(self):
+        return 'Not(%r)' % (self.query,)
+
+class In(object):
+    """Search for any of several values using a helper
+    """
+
+    def __init__(self, name, values):
+        self.name = name
+        self.values = list(values)
+
+    def __repr__(self):
+        return 'In(%r, %r)' % (self.name, self.values)
+
+_ranges = 'le', 'ge', 'range'
+
+Candidates = collections.namedtuple('Candidates', 'ranked limit truncated')
+
+ResultCacheInfo = collections.namedtuple(
+    'ResultCacheInfo',
+    'hits misses evictions invalidations maxsize currsize maxbytes currbytes')
+
+QueryEvent = collections.namedtuple(
+    'QueryEvent',
+    'method names order_by template params build_time execute_time rows'
+    ' cursor')
+
+def _names(query):
+    if isinstance(query, dict):
+        return set(query)
+    if isinstance(query, In):
+        return set((query.name,))
+    if isinstance(query, Not):
+        return _names(query.query)
+    if isinstance(query, _Operation):
+        query = query.queries
+    return set(name for q in query for name in _names(q))
+
+def _count_result(mode, row):
+    if mode == 'estimate':
+        [explain] = row
+        if not isinstance(explain, list):
+            explain = json.loads(explain)
+        return int(explain[0]['Plan']['Plan Rows'])
+    return row[0]
+
+def _page_token(order_by, rows, size):
+    token = None
+    if len(rows) > size:
+        rows = rows[:size]
+        last = rows[-1]
+        token = _encode_token(order_by, list(last[2:]) + [last[0]])
+    return rows, token
+
+def _facets(facets):
+    facets = [(facet, None) if isinstance(facet, str) else tuple(facet)
+              for facet in facets]
+    names = [name for name, _ in facets]
+    if len(set(names)) < len(names):
+        # Counts are returned by name.
+        raise ValueError("Duplicate facet names", names)
+    return facets
+
+def _facet_counts(facets, rows):
+    result = dict((name, {}) for name, _ in facets)
+    for i, value, count in rows:
+        name, buckets = facets[i]
+        if buckets is not None and value is not None:
+            bounds = [None] + list(buckets) + [None]
+            value = bounds[value], bounds[value + 1]
+        result[name][value] = count
+    return result
+
+def _freeze(params):
+    return tuple(_freeze(p) if isinstance(p, (list, tuple)) else p
+                 for p in params)
+
+def _result_size(key, value):
+    # A rough estimate: the template, the parameters and 8 bytes for
+    # each object id, plus the sizes of any ghost pickles.
+    _, template, params = key
+    return (100 + len(template) + len(repr(params)) +
+            sum(8 + len(row[1]) if isinstance(row, tuple) else 8
+                for row in value[0]))
+
+def _conjunction(wheres):
+    if not wheres:
+        return b'true'
+    if len(wheres) == 1:
+        return wheres[0]
+    return b'(' + b' AND '.join(wheres) + b')'
+
+def _new_conditions(wheres, conditions):
+    # Conditions to be combined with wheres using AND, leaving out
+    # repeated conditions without parameters, such as scopes.
+    return [where for where in conditions
+            if has_placeholder(where) or where not in wheres]
+
+def _encode_token(order_by, keys):
+    data = json.dumps(dict(order_by=order_by, keys=keys))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+def _decode_token(token, order_by):
+    try:
+        data = json.loads(
+            base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        keys = data['keys']
+        if [tuple(item) for item in data['order_by']] == list(order_by):
+            return keys
+    except Exception:
+        pass
+    raise ValueError("Invalid page token", token)
+
+# Attributes created when first used, so that QBE objects unpickled
+# without them, including those pickled by earlier versions, work.
+_lazy = dict(
+    _plans=lambda qbe: LRU(qbe._plan_cache_size),
+    _results=lambda qbe: LRU(qbe._result_cache_size,
+                             maxbytes=qbe._result_cache_bytes,
+                             sizeof=_result_size),
+    index_groups=lambda qbe: {},
+    hints=lambda qbe: {},
+    observers=lambda qbe: [],
+    )
+
+# Caches and observers aren't pickled.
+_transient = (
+    '_plans', '_results', '_results_tid', '_results_invalidations',
+    'observers')
 
 class QBE(dict):
 
+    _plan_cache_size = 100
+    _result_cache_size = 0
+    _result_cache_bytes = 1 << 24
+    _results_tid = None
+    _results_invalidations = 0
+
+    def __init__(self, *args, **kw):
+        super(QBE, self).__init__(*args, **kw)
+        self.index_groups = {}
+        self.hints = {}
+        self.observers = []
+
+    def __getattr__(self, name):
+        factory = _lazy.get(name)
+        if factory is None:
+            raise AttributeError(name)
+        return self.__dict__.setdefault(name, factory(self))
+
+    def __getstate__(self):
+        return dict((name, value) for name, value in self.__dict__.items()
+                    if name not in _transient)
+
+    @property
+    def plan_cache_size(self):
+        return self._plan_cache_size
+
+    @plan_cache_size.setter
+    def plan_cache_size(self, size):
+        self._plan_cache_size = self._plans.maxsize = size
+
+    def plan_cache_info(self):
+        return self._plans.info()
+
+    def plan_cache_clear(self):
+        self._plans.clear()
+
+    @property
+    def result_cache_size(self):
+        return self._result_cache_size
+
+    @result_cache_size.setter
+    def result_cache_size(self, size):
+        self._result_cache_size = self._results.maxsize = size
+        if not size:
+            self._results.purge()
+
+    @property
+    def result_cache_bytes(self):
+        return self._result_cache_bytes
+
+    @result_cache_bytes.setter
+    def result_cache_bytes(self, size):
+        self._result_cache_bytes = self._results.maxbytes = size
+
+    def result_cache_info(self):
+        results = self._results
+        return ResultCacheInfo(
+            results.hits, results.misses, results.evictions,
+            self._results_invalidations, results.maxsize, len(results),
+            results.maxbytes, results.currbytes)
+
+    def result_cache_clear(self):
+        self._results.clear()
+        self._results_tid = None
+        self._results_invalidations = 0
+
+    def _result_key(self, conn, template, params):
+        # Results are cached by SQL template and parameters, which
+        # reflect the normalized query shape and ordering, and by the
+        # last committed transaction id seen by the connection.
+        if not self._results.maxsize:
+            return None
+        try:
+            params = _freeze(params)
+            hash(params)
+        except TypeError:
+            return None # Data we can't compare
+
+        tid = _storage(conn).lastTransaction()
+        if self._results_tid is None or tid > self._results_tid:
+            if self._results_tid is not None:
+                self._results_invalidations += self._results.purge()
+            self._results_tid = tid
+        return tid, template, params
+
+    def _plan(self, query, order_by, form='sql'):
+        order_by = _order_by(order_by)
+        node = query if isinstance(query, dict) else self._simplify(query)
+        if isinstance(node, dict):
+            where = ('dict', self._shape(node))
+        else:
+            where = self._flatten(node)[0]
+        key = (
+            form,
+            where,
+            tuple((name, id(self[name]), desc) for name, desc in order_by),
+            )
+        plan = self._plans.get(key)
+        if plan is None:
+            plan = self._plans[key] = self._compile(node, order_by, form)
+        return plan
+
+    def _shape(self, query):
+        return tuple(sorted((name, id(self[name]),
+                             getattr(self[name], 'shape', _no_shape)(q))
+                            for name, q in query.items()))
+
+    def _simplify(self, node):
+        """Flatten nested boolean operations and merge criteria
+
+        Criteria mappings combined with ``And`` are merged, collapsing
+        ranges for the same helper.
+        """
+        if isinstance(node, dict):
+            return node
+        if isinstance(node, Not):
+            return Not(self._simplify(node.query))
+        if isinstance(node, In):
+            return node
+        if not isinstance(node, _Operation):
+            raise TypeError("Invalid query", node)
+
+        queries = []
+        for query in node.queries:
+            query = self._simplify(query)
+            if query.__class__ is node.__class__:
+                queries.extend(query.queries)
+            else:
+                queries.append(query)
+
+        if isinstance(node, Or):
+            return queries[0] if len(queries) == 1 else Or(*queries)
+
+        merged = {}
+        rest = []
+        for query in queries:
+            if not isinstance(query, dict):
+                rest.append(query)
+                continue
+            unmerged = {}
+            for name, value in query.items():
+                if name not in merged:
+                    merged[name] = value
+                else:
+                    value = self._intersect(name, merged[name], value)
+                    if value is None:
+                        unmerged[name] = query[name]
+                    else:
+                        merged[name] = value
+            if unmerged:
+                rest.append(unmerged)
+
+        if not rest:
+            return merged
+        return And(merged, *rest) if merged else And(*rest)
+
+    def _intersect(self, name, a, b):
+        # Combine ranges for a helper, or return None if we can't.
+        shape = getattr(self[name], 'shape', _no_shape)
+        if not (isinstance(a, tuple) and isinstance(b, tuple) and
+                shape(a) in _ranges and shape(b) in _ranges):
+            return None
+        # Bounds are compared after conversion, and returned as given,
+        # since they're converted again when binding.
+        convert = getattr(self[name], 'convert', _same)
+        try:
+            mins = [(convert(v), v) for v in (a[0], b[0]) if v is not None]
+            maxes = [(convert(v), v) for v in (a[1], b[1]) if v is not None]
+            return (max(mins, key=_first)[1] if mins else None,
+                    min(maxes, key=_first)[1] if maxes else None)
+        except (TypeError, ValueError):
+            return None # Bounds we can't compare
+
+    def _flatten(self, node):
+        """Return a shape key and criteria for a simplified query tree
+
+        Criteria are ``(name, value)`` tuples, in the order in which
+        they are compiled.
+        """
+        criteria = []
+
+        def walk(node):
+            if isinstance(node, dict):
+                criteria.extend((name, node[name]) for name in sorted(node))
+                return 'dict', self._shape(node)
+            if isinstance(node, Not):
+                return 'not', walk(node.query)
+            if isinstance(node, In):
+                helper = self[node.name]
+                if _template(helper, 'any_template', '__call__'):
+                    criteria.append((node.name, node.values))
+                    return 'in', node.name, id(helper)
+                criteria.extend((node.name, v) for v in node.values)
+                shape = getattr(helper, 'shape', _no_shape)
+                return ('in', node.name, id(helper),
+                        tuple(shape(v) for v in node.values))
+            return (node.__class__.__name__,
+                    tuple(walk(query) for query in node.queries))
+
+        return walk(node), criteria
+
+    def _bindings(self, query):
+        # Return a mapping of criteria keys to query data for binding.
+        if not isinstance(query, dict):
+            query = self._simplify(query)
+            if not isinstance(query, dict):
+                bindings = {}
+                for i, (name, value) in enumerate(self._flatten(query)[1]):
+                    bindings[i] = value
+                    bindings.setdefault(name, value)
+                return bindings
+        return query
+
+    def hint(self, name, selectivity=None, cost=None):
+        self[name] # Check the name
+        self.hints[name] = selectivity, cost
+        self.plan_cache_clear()
+
+    def estimate_selectivity(self, conn, query):
+        total = max(self.count(conn, {}, 'estimate'), 1)
+        estimates = {}
+        for name, value in query.items():
+            estimates[name] = min(
+                self.count(conn, {name: value}, 'estimate') / float(total),
+                1.0)
+            self.hint(name, estimates[name], self.hints.get(name, (0, None))[1])
+        return estimates
+
+    def _rank(self, name):
+        # The expected cost of a condition per row it eliminates, so
+        # cheap, selective conditions come first.
+        selectivity, cost = self.hints.get(name, (None, None))
+        if selectivity is None:
+            selectivity = .5
+        if cost is None:
+            cost = 1
+        return cost / (1.0 - selectivity) if selectivity < 1 else float('inf')
+
+    def _group_order(self, names):
+        # Put conditions on the leading columns of the composite index
+        # that covers the most of them first, in column order.
+        best = ()
+        for group in sorted(self.index_groups):
+            leading = tuple(itertools.takewhile(
+                lambda name: name in names,
+                (name for name, _ in self.index_groups[group])))
+            if len(leading) > len(best):
+                best = leading
+        names = list(best) + [name for name in names if name not in best]
+        if self.hints:
+            names.sort(key=self._rank)
+        return names
+
+    def _scopes(self, names):
+        # Scope conditions of helpers with partial indexes
+        scopes = []
+        for name in names:
+            scope = getattr(self[name], 'scope', None)
+            if scope:
+                scope = b'(' + _bytes(scope).replace(b'%', b'%%') + b')'
+                if scope not in scopes:
+                    scopes.append(scope)
+        return scopes
+
+    def _conditions(self, criteria):
+        """Compile criteria, given as ``(key, name, value)`` tuples
+
+        Lists of SQL conditions and binders are returned.  Binders get
+        data from bindings with the given keys.
+        """
+        binders = []
+        wheres = []
+        keys = dict((name, (key, value)) for key, name, value in criteria)
+        containments = []
+        for name in self._group_order([name for _, name, _ in criteria]):
+            key, value = keys[name]
+            helper = self[name]
+            template = _template(helper, 'template', '__call__')
+            if isinstance(helper, match) and template is not None:
+                # Merge into the first containment condition that
+                # doesn't have an overlapping path.
+                for containment in containments:
+                    if containment.accepts(helper.path):
+                        break
+                else:
+                    containment = _Containment()
+                    containments.append(containment)
+                    wheres.append(_bytes(template(value)))
+                    binders.append((_QUERY, None, containment))
+                containment.helpers.append((key, helper))
+            elif template is None:
+                wheres.append(b'%s')
+                binders.append((_RAW, key, helper))
+            else:
+                wheres.append(_bytes(template(value)))
+                binders.append((_PARAMS, key, helper.params))
+        return wheres, binders
+
+    def _node(self, node, keys):
+        """Compile a simplified query tree
+
+        Return SQL conditions, to be combined with ``AND``, and binders.
+        Scope conditions are included with the conditions of scoped
+        helpers, so they're negated or combined with ``OR`` with them.
+        """
+        if isinstance(node, dict):
+            wheres, binders = self._conditions(
+                [(next(keys), name, node[name]) for name in sorted(node)])
+            return self._scopes(sorted(node)) + wheres, binders
+
+        if isinstance(node, In):
+            helper = self[node.name]
+            if _template(helper, 'any_template', '__call__'):
+                return (self._scopes([node.name]) +
+                        [_bytes(helper.any_template(node.values))],
+                        [(_PARAMS, next(keys), helper.any_params)])
+            node = Or(*[{node.name: v} for v in node.values])
+
+        if isinstance(node, Not):
+            wheres, binders = self._node(node.query, keys)
+            return [b'NOT ' + _conjunction(wheres)], binders
+
+        wheres = []
+        binders = []
+        for query in node.queries:
+            query_wheres, query_binders = self._node(query, keys)
+            binders.extend(query_binders)
+            if isinstance(node, And):
+                wheres.extend(_new_conditions(wheres, query_wheres))
+            else:
+                wheres.append(_conjunction(query_wheres))
+
+        if isinstance(node, Or):
+            wheres = [b'(' + b' OR\n   '.join(wheres) + b')'
+                      if wheres else b'false']
+        return wheres, binders
+
+    def _compile(self, query, order_by, form):
+        if isinstance(query, dict):
+            criteria = [(name, name, query[name]) for name in sorted(query)]
+            names = sorted(query)
+            wheres, binders = self._conditions(criteria)
+        else:
+            # Scopes for search criteria are included by _node.
+            names = []
+            wheres, binders = self._node(query, itertools.count())
+            query = self._bindings(query)
+
+        wheres[:0] = _new_conditions(wheres, self._scopes(
+            itertools.chain(names, (name for name, _ in order_by))))
+        where = (b' AND\n  '.join(wheres) if wheres else b'true'), binders
+
+        orders = []
+        for name, desc in order_by:
+            helper = self[name]
+            template = _template(helper, 'order_template', 'order_by')
+            if template is None:
+                order = b'%s'
+                binder = (_RAW, name, helper.order_by)
+            else:
+                order = template(query.get(name))
+                if order is None:
+                    raise ValueError("Can't order by %r" % name)
+                order = _bytes(order)
+                binder = (_PARAMS, name, helper.order_params)
+            orders.append((order, (binder, ), desc))
+
+        if isinstance(form, tuple):
+            # Forms with extra compile-time arguments
+            form, args = form[0], form[1:]
+        else:
+            args = ()
+        return _Plan(*_forms[form](where, orders, *args),
+                     bindings=self._bindings)
+
+    def _notify(self, method, query, order_by, template, params,
+                started, built, done=None, rows=None, cursor=None):
+        event = QueryEvent(
+            method, tuple(sorted(_names(query))), _order_by(order_by),
+            template, params, built - started,
+            None if done is None else done - built, rows, cursor)
+        for observer in self.observers:
+            observer(event)
+
+    def _run(self, cursor, method, query, order_by, started,
+             template, params, run=execute):
+        # Execute a query and fetch the results, reporting to observers
+        built = _timer()
+        run(cursor, template, params)
+        rows = cursor.fetchall()
+        if self.observers:
+            self._notify(method, query, order_by, template, params,
+                         started, built, _timer(), len(rows), cursor)
+        return rows
+
     def sql(self, conn, query, order_by=()):
+        started = _timer()
+        result = self._sql(conn, query, order_by)
+        if self.observers:
+            self._notify('sql', query, order_by, result, (),
+                         started, _timer())
+        return result
+
+    def _sql(self, conn, query, order_by):
+        plan = self._plan(query, order_by)
+        if plan.raw:
+            with contextlib.closing(read_only_cursor(conn)) as cursor:
+                params = plan.bind(cursor, query)
+        else:
+            params = plan.bind(None, query)
+
+        try:
+            return literal.substitute(plan.fragments, params)
+        except TypeError:
+            if conn is None:
+                raise
+
+        # Data that can only be quoted by the database driver
+        with contextlib.closing(read_only_cursor(conn)) as cursor:
+            return cursor.mogrify(plan.template, params)
+
+    def sql_params(self, conn, query, order_by=()):
+        started = _timer()
+        plan = self._plan(query, order_by)
+        if not plan.raw:
+            template, params = plan.render(None, query)
+        else:
+            with contextlib.closing(read_only_cursor(conn)) as cursor:
+                template, params = plan.render(cursor, query)
+        if self.observers:
+            self._notify('sql_params', query, order_by, template, params,
+                         started, _timer())
+        return template, params
+
+    def search(self, conn, query, order_by=()):
+        started = _timer()
+        plan = self._plan(query, order_by, 'search')
+        get = conn.ex_get
+        with contextlib.closing(read_only_cursor(conn)) as cursor:
+            template, params = plan.render(cursor, query)
+            key = self._result_key(conn, template, params)
+            cached = None if key is None else self._results.get(key)
+            if cached is None:
+                rows = self._run(cursor, 'search', query, order_by, started,
+                                 template, params, _runner(plan))
+            else:
+                rows = cached[0]
+
+        if key is not None and cached is None:
+            # Ghost pickles are cached too, so hits don't load objects.
+            self._results[key] = tuple(rows), None
+        return [get(p64(zoid), ghost_pickle) for (zoid, ghost_pickle) in rows]
+
+    def search_zoids(self, conn, query, order_by=()):
+        started = _timer()
+        plan = self._plan(query, order_by, 'zoids')
+        with contextlib.closing(read_only_cursor(conn)) as cursor:
+            template, params = plan.render(cursor, query)
+            key = self._result_key(conn, template, params)
+            cached = None if key is None else self._results.get(key)
+            if cached is not None:
+                return list(cached[0])
+            rows = self._run(cursor, 'search_zoids', query, order_by,
+                             started, template, params, _runner(plan))
+
+        zoids = [zoid for (zoid,) in rows]
+        if key is not None:
+            self._results[key] = tuple(zoids), None
+        return zoids
+
+    def search_many(self, conn, queries, order_by=()):
+        started = _timer()
+        sql = []
+        params = []
+        with contextlib.closing(read_only_cursor(conn)) as cursor:
+            for i, query in enumerate(queries):
+                template, query_params = self._plan(
+                    query, order_by, 'numbered').render(cursor, query)
+                sql.append(('select %d, numbered.* from (\n' % i).encode(
+                    'ascii') + template + b') numbered')
+                params.extend(query_params)
+            if not sql:
+                return []
+            # The combined statement varies with the number and shapes of
+            # the queries, so it isn't prepared.
+            rows = self._run(cursor, 'search_many', queries, order_by, started,
+                             b'\nUNION ALL\n'.join(sql) + b'\nORDER BY 1, 4',
+                             params, _direct)
+
+        get = conn.ex_get
+        results = [[] for _ in sql]
+        for i, zoid, ghost_pickle, _ in rows:
+            results[i].append(get(p64(zoid), ghost_pickle))
+        return results
+
+    def iter_search(self, conn, query, order_by=(), batch_size=1000):
+        plan = self._plan(query, order_by, 'search')
+        get = conn.ex_get
+        with contextlib.closing(read_only_cursor(conn)) as cursor:
+            template, params = plan.render(cursor, query)
+            named = cursor.connection.cursor(
+                'newt_qbe_iter_%d' % next(_cursor_names))
+
+        try:
+            named.itersize = batch_size
+            named.execute(template, params)
+            while True:
+                rows = named.fetchmany(batch_size)
+                if not rows:
+                    break
+                for zoid, ghost_pickle in rows:
+                    yield get(p64(zoid), ghost_pickle)
+        finally:
+            try:
+                named.close()
+            except Exception:
+                pass # The transaction may have ended
+
+    def _count_plan(self, query, mode):
+        if mode not in ('exact', 'capped', 'estimate'):
+            raise ValueError("Invalid count mode", mode)
+        return self._plan(query, (), 'count' if mode == 'exact' else mode)
+
+    def count(self, conn, query, mode='exact', cap=1000):
+        started = _timer()
+        plan = self._count_plan(query, mode)
+        with contextlib.closing(read_only_cursor(conn)) as cursor:
+            template, params = plan.render(cursor, query, (cap,))
+            [row] = self._run(
+                cursor, 'count', query, (), started, template, params,
+                _direct if mode == 'estimate' else _runner(plan))
+            return _count_result(mode, row)
+
+    def search_batch(self, conn, query, order_by=(),
+                     batch_start=0, batch_size=20, cte=False):
+        started = _timer()
+        plan = self._plan(query, order_by, 'cte_batch' if cte else 'batch')
+        get = conn.ex_get
+        with contextlib.closing(read_only_cursor(conn)) as cursor:
+            template, params = plan.render(
+                cursor, query, (batch_start, batch_size))
+            key = self._result_key(conn, template, params)
+            cached = None if key is None else self._results.get(key)
+            if cached is None:
+                rows = self._run(cursor, 'search_batch', query, order_by,
+                                 started, template, params, _runner(plan))
+
+        if cached is not None:
+            rows, total = cached
+        else:
+            if rows:
+                total = rows[0][2]
+            elif batch_start:
+                # We're past the end, so we didn't get a total.
+                total = self.count(conn, query)
+            else:
+                total = 0
+            rows = tuple(row[:2] for row in rows)
+            if key is not None:
+                self._results[key] = rows, total
+
+        return [get(p64(zoid), ghost_pickle)
+                for zoid, ghost_pickle in rows], total
+
+    def _page_plan(self, query, order_by, size, after):
+        if after:
+            extra = _decode_token(after, order_by)
+            plan = self._plan(query, order_by, 'page_after')
+        else:
+            extra = []
+            plan = self._plan(query, order_by, 'page')
+        extra.append(size + 1)
+        return plan, extra
+
+    def page(self, conn, query, order_by=(), size=20, after=None):
+        started = _timer()
+        order_by = _order_by(order_by)
+        plan, extra = self._page_plan(query, order_by, size, after)
+        get = conn.ex_get
+        with contextlib.closing(read_only_cursor(conn)) as cursor:
+            template, params = plan.render(cursor, query, extra)
+            rows = self._run(cursor, 'page', query, order_by, started,
+                             template, params, _runner(plan))
+
+        rows, token = _page_token(order_by, rows, size)
+        return ([get(p64(row[0]), row[1]) for row in rows], token)
+
+    def add_index_group(self, name, columns):
+        from .indexes import group_index_sql
+        if name in self:
+            raise ValueError("Index group name is a helper name", name)
+        columns = _order_by(columns)
+        group_index_sql(self, name, columns) # Check the helpers
+        self.index_groups[name] = columns
+        self.plan_cache_clear()
+
+    def infer_index_groups(self, samples, min_count=1):
+        from .indexes import infer_groups
+        return infer_groups(self, samples, min_count)
+
+    def top(self, conn, query, order_by, k=20, candidates=1000, proxy=()):
+        started = _timer()
+        proxy = _order_by(proxy)
+        order_by = proxy + _order_by(order_by)
+        plan = self._plan(query, order_by, ('top', len(proxy)))
+        get = conn.ex_get
+        with contextlib.closing(read_only_cursor(conn)) as cursor:
+            template, params = plan.render(cursor, query, (candidates, k))
+            rows = self._run(cursor, 'top', query, order_by, started,
+                             template, params, _runner(plan))
+
+        ranked = rows[0][2] if rows else 0
+        return ([get(p64(zoid), ghost_pickle)
+                 for zoid, ghost_pickle, _ in rows],
+                Candidates(ranked, candidates, ranked >= candidates))
+
+    def facets(self, conn, query, facets, exclude_own=True):
+        started = _timer()
+        facets = _facets(facets)
         with contextlib.closing(read_only_cursor(conn)) as cursor:
-            result = []
-            wheres = [self[name](cursor, q) for name, q in query.items()]
-            if wheres:
-                result.append(
-                    b' AND\n  '.join(
-                        self[name](cursor, q)
-                        for name, q in sorted(query.items())
-                        )
-                    )
+            template, params = self._facets_sql(
+                cursor, query, facets, exclude_own)
+            # Facet expressions don't need cursors, so the SQL includes
+            # rendered data if the query's does.
+            rows = self._run(cursor, 'facets', query, (), started,
+                             template, params,
+                             _runner(self._plan(query, ())))
+        return _facet_counts(facets, rows)
+
+    def _facets_sql(self, cursor, query, facets, exclude_own):
+        # Facet values are selected, along with the conditions for
+        # facet helpers if they're excluded from their own counts, in
+        # a common table expression evaluating the rest of the query.
+        if exclude_own and isinstance(query, dict):
+            own = [name for name, _ in facets if name in query]
+            shared = dict((name, value) for name, value in query.items()
+                          if name not in own)
+        else:
+            own = []
+            shared = query
+
+        columns = []
+        params = []
+        for i, (name, buckets) in enumerate(facets):
+            helper = self[name]
+            if not isinstance(helper, (scalar, span, text_array)):
+                raise ValueError("Can't compute facets for %r" % name)
+            expr = helper.expr
+            if buckets is None and getattr(helper, 'bucket_expr', None):
+                expr = helper.bucket_expr
+            expr = _bytes(expr).replace(b'%', b'%%')
+            if buckets is not None:
+                expr = b'width_bucket(' + expr + b', %s)'
+                params.append(list(buckets))
+            columns.append(expr + (' AS f%d' % i).encode('ascii'))
+
+        for i, name in enumerate(own):
+            template, own_params = self._plan(
+                {name: query[name]}, ()).render(cursor, query)
+            columns.append(b'(' + template + (') AS c%d' % i).encode('ascii'))
+            params.extend(own_params)
+
+        template, shared_params = self._plan(shared, ()).render(
+            cursor, shared)
+        cte = (b'WITH matches AS (\n  SELECT ' + b', '.join(columns) +
+               b'\n  FROM newt WHERE ' + template + b')\n')
+        params.extend(shared_params)
+
+        sql = []
+
+        for i, (name, buckets) in enumerate(facets):
+            source = 'matches'
+            value = 'f%d' % i
+            if isinstance(self[name], text_array):
+                source += (
+                    ", jsonb_array_elements_text(CASE WHEN"
+                    " jsonb_typeof(f%d) = 'array' THEN f%d END) v" %
+                    (i, i) if self[name].json else
+                    ', unnest(f%d) v' % i)
+                value = 'v'
+            conditions = ['c%d' % j for j, other in enumerate(own)
+                          if other != name]
+            sql.append((
+                'SELECT %d, to_jsonb(%s), count(*) FROM %s%s GROUP BY 2' % (
+                    i, value, source,
+                    ' WHERE ' + ' AND '.join(conditions)
+                    if conditions else '')
+                ).encode('ascii'))
+
+        return cte + b'\nUNION ALL\n'.join(sql), params
+
+    def index_sql(self, *names, **options):
+        from .indexes import group_index_sql, covering_index_sql
+        covering = options.pop('covering', False)
+        if options:
+            raise TypeError("Unexpected options", sorted(options))
+        result = []
+        for name in sorted(names or list(self) + list(self.index_groups)):
+            if name in self.index_groups:
+                sql = group_index_sql(self, name, self.index_groups[name])
+            elif hasattr(self[name], 'index_sql'):
+                if not (names or getattr(self[name], 'indexable', True)):
+                    continue # Only fail if asked for it
+                sql = self[name].index_sql(name)
             else:
-                result.append(b'true')
-
-
-            if order_by:
-                if isinstance(order_by, str):
-                    order_by = (order_by,)
-                result.append(
-                    b'\nORDER BY ' +
-                    b',\n  '.join(
-                        self[item].order_by(cursor, query.get(item))
-                        if isinstance(item, str) else
-                        self[item[0]].order_by(cursor, query.get(item[0]))
-                        + (b' DESC' if item[1] else b'')
-                        for item in order_by
-                        ))
-
-        return b''.join(result)
-
-    def index_sql(self, *names):
-        return [self[name].index_sql(name)
+                continue
+            if covering:
+                sql = covering_index_sql(self, name, sql)
+            result.append(sql)
+        return result
+
+    def column_sql(self, *names):
+        return [sql
                 for name in sorted(names or self)
-                if hasattr(self[name], 'index_sql')
+                if hasattr(self[name], 'column_sql')
+                for sql in self[name].column_sql()
                 ]
+
+    def backfill(self, dsn, names=(), batch_size=1000, progress=None):
+        from .indexes import backfill
+        return backfill(dsn, self, names, batch_size, progress)
+
+    def advise(self, conn, samples=(), enable_seqscan=True):
+        from .indexes import advise
+        return advise(conn, self, samples, enable_seqscan)
+
+    def build_indexes(self, dsn, names=(),
+                      maintenance_work_mem=None, lock_timeout=None,
+                      progress=None, interval=10, covering=False):
+        from .indexes import build
+        return build(dsn, self, names, maintenance_work_mem, lock_timeout,
+                     progress, interval, covering)
+
+_cursor_names = itertools.count()
+
+def _direct(cursor, template, params):
+    # Execute without preparing, for statements that can't be prepared,
+    # like EXPLAIN, or that are unlikely to be executed again.
+    cursor.execute(template, params)
+
+def _runner(plan):
+    # SQL rendered with data by helpers without templates varies with
+    # the data, so preparing it wouldn't be worthwhile.
+    return _direct if plan.raw else execute
+
+def _same(value):
+    return value
+
+def _first(pair):
+    return pair[0]
+
+def _no_shape(query):
+    return None
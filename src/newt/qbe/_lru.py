@@ -0,0 +1,77 @@
+import collections
+import threading
+
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+class LRU(object):
+    """Small thread-safe least-recently-used mapping with hit/miss counts
+
+    If a ``sizeof`` function is given, it's called with keys and values
+    to estimate their sizes, and entries are evicted to keep the total
+    size within ``maxbytes``.
+    """
+
+    def __init__(self, maxsize, evicted=None, maxbytes=None, sizeof=None):
+        self.maxsize = maxsize
+        self.evicted = evicted
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = self.misses = self.evictions = self.currbytes = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                item = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = item
+            self.hits += 1
+            return item[0]
+
+    def __setitem__(self, key, value):
+        size = self.sizeof(key, value) if self.sizeof is not None else 0
+        evicted = []
+        with self._lock:
+            data = self._data
+            old = data.pop(key, None)
+            if old is not None:
+                self.currbytes -= old[1]
+            data[key] = value, size
+            self.currbytes += size
+            while data and (
+                len(data) > self.maxsize or
+                (self.maxbytes is not None and self.currbytes > self.maxbytes)
+                ):
+                old_key, (old_value, old_size) = data.popitem(False)
+                self.currbytes -= old_size
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+
+        if self.evicted is not None:
+            for key, value in evicted:
+                self.evicted(key, value)
+
+    def __len__(self):
+        return len(self._data)
+
+    def purge(self):
+        """Discard all entries, keeping statistics
+
+        The number of entries discarded is returned.
+        """
+        with self._lock:
+            purged = len(self._data)
+            self._data.clear()
+            self.currbytes = 0
+            return purged
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = self.evictions = self.currbytes = 0
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
@@ -0,0 +1,198 @@
+"""Running QBE searches with asyncio (Python 3.5 and later)
+
+Functions take a QBE object and an asynchronous database connection
+or pool.  Connections are expected to work like `aiopg
+<https://aiopg.readthedocs.io>`_ connections: ``await conn.cursor()``
+returns a cursor with ``execute``, ``fetchall`` and ``fetchone``
+coroutines, and pools provide an ``acquire`` method returning an
+asynchronous context manager.  Small ``connect`` and ``Pool``
+implementations, based on psycopg2's asynchronous support, are
+provided here.
+
+Queries issued together against a pool, for example with
+``asyncio.gather``, run concurrently on separate connections.
+"""
+import asyncio
+
+import psycopg2
+import psycopg2.extensions
+from ZODB.utils import p64
+
+from . import _count_result, _facet_counts, _facets, _order_by, _page_token
+
+async def _wait(conn):
+    loop = asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError("Bad poll state", state)
+
+        ready = loop.create_future()
+        def wake():
+            if not ready.done():
+                ready.set_result(None)
+
+        fileno = conn.fileno()
+        add(fileno, wake)
+        try:
+            await ready
+        finally:
+            remove(fileno)
+
+class Cursor(object):
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._cursor = conn.cursor()
+
+    async def execute(self, sql, params=()):
+        self._cursor.execute(sql, params)
+        await _wait(self._conn)
+
+    async def fetchall(self):
+        return self._cursor.fetchall()
+
+    async def fetchone(self):
+        return self._cursor.fetchone()
+
+    def mogrify(self, sql, params=()):
+        return self._cursor.mogrify(sql, params)
+
+    def close(self):
+        self._cursor.close()
+
+class Connection(object):
+    """Asynchronous psycopg2 connection
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    async def cursor(self):
+        return Cursor(self._conn)
+
+    @property
+    def closed(self):
+        return self._conn.closed
+
+    def close(self):
+        self._conn.close()
+
+async def connect(dsn):
+    """Open an asynchronous connection
+    """
+    conn = psycopg2.connect(dsn, async_=True)
+    await _wait(conn)
+    return Connection(conn)
+
+class _Acquired(object):
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def __aenter__(self):
+        self.conn = await self.pool._get()
+        return self.conn
+
+    async def __aexit__(self, *exc_info):
+        self.pool._put(self.conn)
+
+class Pool(object):
+    """Pool of at most ``size`` asynchronous connections
+    """
+
+    def __init__(self, dsn, size=10):
+        self.dsn = dsn
+        self.size = size
+        self._free = []
+        self._semaphore = None
+
+    def acquire(self):
+        return _Acquired(self)
+
+    async def _get(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.size)
+        await self._semaphore.acquire()
+        try:
+            while self._free:
+                conn = self._free.pop()
+                if not conn.closed:
+                    return conn
+            return await connect(self.dsn)
+        except Exception:
+            self._semaphore.release()
+            raise
+
+    def _put(self, conn):
+        self._free.append(conn)
+        self._semaphore.release()
+
+    def close(self):
+        while self._free:
+            self._free.pop().close()
+
+async def _query(db, render, fetch='fetchall'):
+    # Render a query with a cursor (helpers that don't provide
+    # templates use cursor.mogrify) and execute it.
+    if hasattr(db, 'acquire'):
+        async with db.acquire() as conn:
+            return await _query(conn, render, fetch)
+
+    cursor = await db.cursor()
+    try:
+        await cursor.execute(*render(cursor))
+        return await getattr(cursor, fetch)()
+    finally:
+        cursor.close()
+
+async def search(qbe, db, query, order_by=()):
+    """Search, returning a list of object ids and ghost pickles
+
+    Pass the result to ``load`` to get objects.
+    """
+    plan = qbe._plan(query, order_by, 'search')
+    return await _query(db, lambda cursor: plan.render(cursor, query))
+
+async def count(qbe, db, query, mode='exact', cap=1000):
+    """Count the objects matching a query
+
+    See ``QBE.count``.
+    """
+    plan = qbe._count_plan(query, mode)
+    row = await _query(db, lambda cursor: plan.render(cursor, query, (cap,)),
+                       'fetchone')
+    return _count_result(mode, row)
+
+async def page(qbe, db, query, order_by=(), size=20, after=None):
+    """Return a page of object ids and ghost pickles and a token
+
+    See ``QBE.page``.
+    """
+    order_by = _order_by(order_by)
+    plan, extra = qbe._page_plan(query, order_by, size, after)
+    rows = await _query(db, lambda cursor: plan.render(cursor, query, extra))
+    rows, token = _page_token(order_by, rows, size)
+    return [row[:2] for row in rows], token
+
+async def facets(qbe, db, query, facets, exclude_own=True):
+    """Count search results by facet values
+
+    See ``QBE.facets``.
+    """
+    facets = _facets(facets)
+    rows = await _query(db, lambda cursor: qbe._facets_sql(
+        cursor, query, facets, exclude_own))
+    return _facet_counts(facets, rows)
+
+def load(conn, rows):
+    """Get objects from a Newt DB connection for search results
+    """
+    get = conn.ex_get
+    return [get(p64(zoid), ghost_pickle) for zoid, ghost_pickle in rows]
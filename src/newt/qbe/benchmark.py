@@ -0,0 +1,260 @@
+"""Benchmarks for QBE helpers on a synthetic dataset
+
+A ``newt`` table is created in a new schema (``newt_qbe_benchmark``
+by default), which mustn't already exist, and filled with generated
+objects.  The schema is dropped afterwards, unless it's kept.
+Searches using each of the built-in helpers are timed without and
+with the indexes returned by ``QBE.index_sql``, and the rate at which
+SQL is generated is measured.  Data are generated from a seed, so runs with the same
+arguments search the same data.
+"""
+import contextlib
+import json
+import platform
+import re
+import time
+
+from timeit import default_timer as timer
+
+from . import QBE, fulltext, match, prefix, scalar, text_array
+
+words = """
+newt zodb database postgresql python search index query object json
+text array prefix path review article comment release document token
+schema table column vector rank match range scalar value cache plan
+shape batch page cursor stream count estimate transaction commit
+""".split()
+
+def qbe():
+    """Return a QBE object for the generated data
+    """
+    qbe = QBE()
+    qbe['type'] = match('type')
+    qbe['stars'] = scalar('stars', 'int')
+    qbe['price'] = scalar('price', 'numeric')
+    qbe['tags'] = text_array('tags(state)')
+    qbe['path'] = prefix('path', delimiter='/')
+    qbe['text'] = fulltext('text', 'english')
+    return qbe
+
+# Names, queries and orderings
+cases = (
+    ('match', dict(type='review'), ()),
+    ('scalar', dict(stars=5), ()),
+    ('scalar_range', dict(price=(10, 12)), ['price']),
+    ('text_array', dict(tags=['newt', 'zodb']), ()),
+    ('prefix', dict(path='/s1/s2'), ()),
+    ('fulltext', dict(text='newt & database'), [('text', True)]),
+    ('combined', dict(type='article', stars=(4, None), path='/s3'),
+     [('price', True)]),
+    )
+
+# Objects are qualified by schema, so that nothing outside the
+# benchmark schema, such as a Newt DB table in the public schema, is
+# changed.  The search path is only used by generated searches.
+_schema_sql = """
+SET search_path = %(schema)s, public;
+CREATE TABLE %(schema)s.newt (
+  zoid bigint primary key,
+  class_name text,
+  ghost_pickle bytea,
+  state jsonb);
+CREATE OR REPLACE FUNCTION %(schema)s.tags(state jsonb) RETURNS text[] AS $$
+  SELECT array(SELECT jsonb_array_elements_text(state -> 'tags'))
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+# Random values are computed in subqueries that refer to the row
+# number, so they're computed for each row.
+_insert_sql = """
+INSERT INTO %(schema)s.newt (zoid, class_name, ghost_pickle, state)
+SELECT g, 'newt.db._object.Object', ''::bytea, jsonb_build_object(
+  'type', (array['review', 'article', 'comment', 'page', 'note'])[
+     1 + floor(random() * 5)::int],
+  'stars', 1 + floor(random() * 5)::int,
+  'price', round((random() * 100)::numeric, 2),
+  'tags', to_jsonb(array(
+     SELECT w FROM unnest(%(words)s::text[]) w
+     WHERE random() < 3.0 / %(nwords)s AND g > 0)),
+  'path', '/s' || floor(random() * 10) || '/s' || floor(random() * 10) ||
+          '/d' || g,
+  'text', array_to_string(array(
+     SELECT (%(words)s::text[])[1 + floor(random() * %(nwords)s)::int]
+     FROM generate_series(1, 30) WHERE g > 0), ' '))
+FROM generate_series(%(start)s, %(end)s) g
+"""
+
+def _quote_identifier(name):
+    return '"%s"' % name.replace('"', '""')
+
+def _generate(cursor, schema, rows, seed, batch_size, progress):
+    schema = _quote_identifier(schema)
+    cursor.execute(_schema_sql % dict(schema=schema))
+    cursor.execute('SELECT setseed(%s)', (seed,))
+    insert_sql = _insert_sql.replace(
+        '%(schema)s', schema.replace('%', '%%'))
+    for start in range(1, rows + 1, batch_size):
+        end = min(start + batch_size - 1, rows)
+        cursor.execute(insert_sql, dict(
+            words=words, nwords=len(words), start=start, end=end))
+        if progress is not None:
+            progress('generated %d rows' % end)
+    cursor.execute('ANALYZE %s.newt' % schema)
+
+def _index_sql(qbe, schema):
+    # The table is private to the benchmark, so indexes needn't be
+    # built concurrently.
+    table = 'ON %s.newt ' % _quote_identifier(schema)
+    return (['CREATE INDEX newt_json_idx %sUSING GIN (state)' % table] +
+            [re.sub(r'\bON newt\s+', table,
+                    re.sub(r'\bCONCURRENTLY\s+', '', sql, flags=re.I))
+             for sql in qbe.index_sql()])
+
+def _drop_indexes(cursor, schema):
+    cursor.execute("""
+    select indexname from pg_indexes
+    where schemaname = %s and tablename = 'newt' and indexname <> 'newt_pkey'
+    """, (schema,))
+    for (name,) in cursor.fetchall():
+        cursor.execute('DROP INDEX %s.%s' % (
+            _quote_identifier(schema), _quote_identifier(name)))
+
+def _statistics(times, rows):
+    times = sorted(times)
+    return dict(
+        min=times[0] * 1000,
+        median=times[len(times) // 2] * 1000,
+        max=times[-1] * 1000,
+        rows=rows,
+        )
+
+def time_queries(cursor, qbe, repeat=5, limit=100):
+    """Time searches for the benchmark cases, in milliseconds
+    """
+    results = {}
+    for name, query, order_by in cases:
+        template, params = qbe.sql_params(None, query, order_by)
+        sql = b'select zoid from newt where ' + template + b'\nLIMIT %s'
+        params = list(params) + [limit]
+        cursor.execute(sql, params) # Warm up caches
+        times = []
+        for _ in range(repeat):
+            start = timer()
+            cursor.execute(sql, params)
+            rows = len(cursor.fetchall())
+            times.append(timer() - start)
+        results[name] = _statistics(times, rows)
+    return results
+
+def time_builds(qbe, iterations=10000):
+    """Measure SQL generation rates, in queries per second
+    """
+    results = {}
+    for name, query, order_by in cases:
+        results[name] = rates = {}
+        for method in (qbe.sql_params, qbe.sql):
+            method(None, query, order_by) # Compile and cache a plan
+            start = timer()
+            for _ in range(iterations):
+                method(None, query, order_by)
+            rates[method.__name__] = iterations / (timer() - start)
+    return results
+
+def _version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('newt.qbe').version
+    except Exception:
+        return None
+
+def run(dsn, rows=100000, seed=.42, repeat=5, iterations=10000, limit=100,
+        schema='newt_qbe_benchmark', keep=False, batch_size=100000,
+        progress=None):
+    """Generate data and run benchmarks, returning a dictionary of results
+    """
+    from newt.db import pg_connection
+
+    results = dict(
+        version=_version(),
+        python=platform.python_version(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        rows=rows, seed=seed, repeat=repeat, limit=limit,
+        )
+    benchmark_qbe = qbe()
+    results['build'] = time_builds(benchmark_qbe, iterations)
+
+    with contextlib.closing(pg_connection(dsn)) as conn:
+        conn.autocommit = True
+        with contextlib.closing(conn.cursor()) as cursor:
+            cursor.execute('show server_version')
+            results['postgresql'] = cursor.fetchone()[0]
+
+            # The schema must be new, since it's dropped afterwards.
+            cursor.execute(
+                'select 1 from pg_namespace where nspname = %s', (schema,))
+            if cursor.fetchall():
+                raise ValueError("Schema already exists", schema)
+            cursor.execute('CREATE SCHEMA %s' % _quote_identifier(schema))
+            try:
+                _generate(cursor, schema, rows, seed, batch_size, progress)
+
+                _drop_indexes(cursor, schema)
+                if progress is not None:
+                    progress('timing queries without indexes')
+                results['without_indexes'] = time_queries(
+                    cursor, benchmark_qbe, repeat, limit)
+
+                results['index_build'] = index_build = {}
+                for sql in _index_sql(benchmark_qbe, schema):
+                    start = timer()
+                    cursor.execute(sql)
+                    index_build[sql.split()[2]] = timer() - start
+                cursor.execute('ANALYZE %s.newt' % _quote_identifier(schema))
+                if progress is not None:
+                    progress('timing queries with indexes')
+                results['with_indexes'] = time_queries(
+                    cursor, benchmark_qbe, repeat, limit)
+            finally:
+                if not keep:
+                    cursor.execute('DROP SCHEMA %s CASCADE' %
+                                   _quote_identifier(schema))
+
+    return results
+
+def main(args=None):
+    """Benchmark QBE helpers on generated data and output JSON results
+    """
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('dsn', help='PostgreSQL connection string')
+    parser.add_argument('-n', '--rows', type=int, default=100000,
+                        help='number of objects to generate')
+    parser.add_argument('-s', '--seed', type=float, default=.42,
+                        help='random seed, between -1 and 1')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='times to run each query')
+    parser.add_argument('-i', '--iterations', type=int, default=10000,
+                        help='times to generate SQL for each query')
+    parser.add_argument('-l', '--limit', type=int, default=100,
+                        help='maximum results per query')
+    parser.add_argument('--schema', default='newt_qbe_benchmark',
+                        help='new schema for the generated data')
+    parser.add_argument('-k', '--keep', action='store_true',
+                        help="keep the generated data")
+    parser.add_argument('-o', '--output', help='output file')
+    options = parser.parse_args(args)
+
+    def progress(message):
+        sys.stderr.write(message + '\n')
+
+    results = run(options.dsn, options.rows, options.seed, options.repeat,
+                  options.iterations, options.limit, options.schema,
+                  options.keep, progress=progress)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
@@ -0,0 +1,384 @@
+"""Checking and maintaining indexes and columns for QBE helpers
+"""
+import collections
+import contextlib
+import json
+import re
+
+from newt.db.search import read_only_cursor
+
+Advice = collections.namedtuple('Advice', 'missing unused seq_scans')
+
+def _normalize(expr):
+    # PostgreSQL deparses index and query expressions with different
+    # parenthesization.
+    return re.sub(r'[\s()]', '', expr)
+
+@contextlib.contextmanager
+def _savepoint(cursor):
+    # Isolate statements that might fail, or that change settings,
+    # from the surrounding transaction.
+    cursor.execute('SAVEPOINT newt_qbe_indexes')
+    try:
+        yield
+    finally:
+        cursor.execute('ROLLBACK TO SAVEPOINT newt_qbe_indexes')
+
+def _explain(cursor, sql, params=()):
+    cursor.execute(b'EXPLAIN (VERBOSE, FORMAT JSON) ' + sql, params)
+    [explain] = cursor.fetchone()
+    if not isinstance(explain, list):
+        explain = json.loads(explain)
+    return explain[0]['Plan']
+
+def _deparse(cursor, expr):
+    """Return PostgreSQL's normalized text for an expression
+    """
+    with _savepoint(cursor):
+        try:
+            plan = _explain(cursor, ('select %s from newt' % expr).encode(
+                'utf-8').replace(b'%', b'%%'))
+        except Exception:
+            return None
+    return _normalize(plan['Output'][0])
+
+def _expected(helper):
+    """Return the expression, access method and operator class of an
+    index a helper can use
+    """
+    from . import match
+    if isinstance(helper, match):
+        # Uses the standard newt JSON GIN index
+        return 'state', 'gin', None
+
+    if not (hasattr(helper, 'index_sql') and hasattr(helper, 'expr') and
+            getattr(helper, 'indexable', True)):
+        return None
+
+    sql = helper.index_sql('x')
+    scope = getattr(helper, 'scope', None)
+    if scope and sql.endswith(' WHERE ' + scope):
+        sql = sql[:-len(' WHERE ' + scope)]
+    method = re.search(r'\bUSING\s+(\w+)', sql, re.I)
+    opclass = re.search(r'\s(\w+_ops)\)\s*$', sql)
+    return (helper.expr,
+            method.group(1).lower() if method else 'btree',
+            opclass.group(1) if opclass else None)
+
+def _btree(helper):
+    expected = _expected(helper)
+    return expected is not None and expected[1] == 'btree'
+
+def group_index_sql(qbe, name, columns):
+    """Return SQL to create a composite index for helper columns
+
+    Columns are helper names and descending flags.
+    """
+    from . import is_paranthesized
+    sql = []
+    scopes = set()
+    for helper_name, desc in columns:
+        helper = qbe[helper_name]
+        if not _btree(helper):
+            raise ValueError("Helper can't be used in a composite index",
+                             helper_name)
+        scopes.add(getattr(helper, 'scope', None))
+        expr, _, opclass = _expected(helper)
+        if not is_paranthesized(expr):
+            expr = '(' + expr + ')'
+        if opclass:
+            expr += ' ' + opclass
+        if desc:
+            expr += ' DESC'
+        sql.append(expr)
+    if len(scopes) > 1:
+        raise ValueError("Helpers in a composite index have different scopes",
+                         name)
+    sql = "CREATE INDEX CONCURRENTLY newt_%s_idx ON newt (%s)" % (
+        name, ', '.join(sql))
+    scope = scopes.pop()
+    if scope:
+        sql += ' WHERE ' + scope
+    return sql
+
+def covering_index_sql(qbe, name, sql):
+    """Add ``zoid`` to a B-tree index, for index-only scans
+    """
+    if name in qbe.index_groups:
+        scope = getattr(qbe[qbe.index_groups[name][0][0]], 'scope', None)
+    elif _btree(qbe[name]):
+        scope = getattr(qbe[name], 'scope', None)
+    else:
+        return sql # Only B-tree indexes can include columns
+
+    if scope and sql.endswith(' WHERE ' + scope):
+        return sql[:-len(' WHERE ' + scope)] + ' INCLUDE (zoid) WHERE ' + scope
+    return sql + ' INCLUDE (zoid)'
+
+def infer_groups(qbe, samples, min_count=1):
+    """Suggest composite index groups for sample queries
+
+    See ``QBE.infer_index_groups``.
+    """
+    from . import _order_by, _no_shape
+    counts = collections.Counter()
+    for sample in samples:
+        query, order_by = (sample if isinstance(sample, tuple)
+                           else (sample, ()))
+        shapes = dict((name, getattr(qbe[name], 'shape', _no_shape)(q))
+                      for name, q in query.items()
+                      if _btree(qbe[name]))
+        equal = sorted(name for name, shape in shapes.items()
+                       if shape == 'eq')
+        columns = [(name, False) for name in equal]
+
+        # Ordering on columns with equality conditions is redundant.
+        order_by = [(name, desc) for name, desc in _order_by(order_by)
+                    if name not in equal]
+        if order_by:
+            if all(_btree(qbe[name]) for name, _ in order_by):
+                columns.extend(order_by)
+        else:
+            ranges = sorted(name for name in shapes if name not in equal)
+            if ranges:
+                columns.append((ranges[0], False))
+
+        if len(columns) > 1:
+            counts[tuple(columns)] += 1
+
+    return dict(
+        ('_'.join(name + ('_desc' if desc else '') for name, desc in columns),
+         list(columns))
+        for columns, count in counts.items()
+        if count >= min_count)
+
+Index = collections.namedtuple(
+    'Index', 'name method opclass expr scans unique valid predicate')
+
+def indexes(cursor):
+    """Return information about the indexes on the newt table
+    """
+    cursor.execute("""
+    select c.relname, am.amname, opc.opcname,
+           pg_get_indexdef(i.indexrelid, 1, true),
+           coalesce(s.idx_scan, 0), i.indisunique, i.indisvalid,
+           pg_get_expr(i.indpred, i.indrelid, true)
+    from pg_index i
+    join pg_class c on c.oid = i.indexrelid
+    join pg_am am on am.oid = c.relam
+    left join pg_opclass opc on opc.oid = i.indclass[0]
+    left join pg_stat_user_indexes s on s.indexrelid = i.indexrelid
+    where i.indrelid = 'newt'::regclass
+    order by c.relname
+    """)
+    return [Index(*row) for row in cursor.fetchall()]
+
+def _seq_scan(plan):
+    if plan['Node Type'] == 'Seq Scan' and plan['Relation Name'] == 'newt':
+        return True
+    return any(_seq_scan(p) for p in plan.get('Plans', ()))
+
+def advise(conn, qbe, samples=(), enable_seqscan=True):
+    """Compare QBE helpers with existing indexes and query plans
+
+    See ``QBE.advise``.
+    """
+    with contextlib.closing(read_only_cursor(conn)) as cursor:
+        existing = [index for index in indexes(cursor) if index.valid]
+
+        missing = []
+        for name in sorted(qbe):
+            expected = _expected(qbe[name])
+            if expected is None:
+                continue
+            expr, method, opclass = expected
+            expr = _deparse(cursor, expr)
+            scope = getattr(qbe[name], 'scope', None)
+            if scope:
+                scope = _deparse(cursor, scope)
+            if not any(index.method == method and
+                       _normalize(index.expr) == expr and
+                       (opclass is None or index.opclass == opclass) and
+                       (index.predicate is None or
+                        _normalize(index.predicate) == scope)
+                       for index in existing):
+                missing.append(name)
+
+        unused = [index.name for index in existing
+                  if not index.scans and not index.unique]
+
+        seq_scans = []
+        for sample in samples:
+            query, order_by = (sample if isinstance(sample, tuple)
+                               else (sample, ()))
+            template, params = qbe._plan(query, order_by, 'search').render(
+                cursor, query)
+            with _savepoint(cursor):
+                if not enable_seqscan:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+                if _seq_scan(_explain(cursor, template, params)):
+                    seq_scans.append(sample)
+
+    return Advice(missing, unused, seq_scans)
+
+_index_name = re.compile(
+    r'CREATE\s+INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)',
+    re.I).match
+
+def _if_not_exists(sql):
+    if re.search(r'\bIF\s+NOT\s+EXISTS\b', sql, re.I):
+        return sql
+    return re.sub(r'^(CREATE\s+INDEX\s+CONCURRENTLY)\s+', r'\1 IF NOT EXISTS ',
+                  sql, flags=re.I)
+
+def _progress(cursor, pid):
+    cursor.execute("""
+    select phase, blocks_done, blocks_total, tuples_done, tuples_total
+    from pg_stat_progress_create_index where pid = %s
+    """, (pid,))
+    return cursor.fetchone()
+
+def build(dsn, qbe, names=(), maintenance_work_mem=None, lock_timeout=None,
+          progress=None, interval=10, covering=False):
+    """Create missing indexes for QBE helpers, one at a time
+
+    See ``QBE.build_indexes``.
+    """
+    from newt.db import pg_connection
+
+    results = []
+    conn = pg_connection(dsn)
+    monitor = pg_connection(dsn)
+    try:
+        conn.autocommit = monitor.autocommit = True
+        cursor = conn.cursor()
+        if maintenance_work_mem:
+            cursor.execute("SET maintenance_work_mem = %s",
+                           (maintenance_work_mem,))
+        if lock_timeout:
+            cursor.execute("SET lock_timeout = %s", (lock_timeout,))
+
+        existing = dict((index.name, index) for index in indexes(cursor))
+        pid = conn.get_backend_pid()
+        for sql in qbe.index_sql(*names, covering=covering):
+            match = _index_name(sql)
+            if match is None:
+                raise ValueError("Not a concurrent index build", sql)
+            name = match.group(1)
+            index = existing.get(name)
+            if index is not None:
+                if index.valid:
+                    results.append((name, 'exists'))
+                    continue
+                # Left by a failed concurrent build
+                cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS ' + name)
+                action = 'rebuilt'
+            else:
+                action = 'created'
+
+            def report():
+                if progress is not None:
+                    row = _progress(monitor.cursor(), pid)
+                    if row is not None:
+                        progress(name, *row)
+
+            _run(cursor, _if_not_exists(sql), report, interval)
+            results.append((name, action))
+    finally:
+        conn.close()
+        monitor.close()
+
+    return results
+
+def backfill(dsn, qbe, names=(), batch_size=1000, progress=None):
+    """Compute stored columns for existing objects, in batches
+
+    See ``QBE.backfill``.
+    """
+    from newt.db import pg_connection
+
+    updated = {}
+    with contextlib.closing(pg_connection(dsn)) as conn:
+        conn.autocommit = True
+        with contextlib.closing(conn.cursor()) as cursor:
+            for name in sorted(names or qbe):
+                sql = getattr(qbe[name], 'backfill_sql', lambda: None)()
+                if not sql:
+                    continue
+                updated[name] = 0
+                last = -1
+                while True:
+                    # Each batch is a separate transaction, to limit
+                    # locking and the size of transactions.
+                    cursor.execute(sql, (last, batch_size))
+                    zoids = [zoid for (zoid,) in cursor.fetchall()]
+                    if not zoids:
+                        break
+                    updated[name] += len(zoids)
+                    last = max(zoids)
+                    if progress is not None:
+                        progress(name, updated[name])
+
+    return updated
+
+def _run(cursor, sql, report, interval):
+    # Execute a statement in a thread, reporting progress while waiting.
+    import threading
+    errors = []
+    def run():
+        try:
+            cursor.execute(sql)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    while True:
+        thread.join(interval)
+        if not thread.is_alive():
+            break
+        try:
+            report()
+        except Exception:
+            pass # Reporting is best effort (and needs PostgreSQL 12)
+
+    if errors:
+        raise errors[0]
+
+def main(args=None):
+    """Create missing indexes for a QBE object
+    """
+    import argparse
+    import importlib
+    import sys
+
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('dsn', help='PostgreSQL connection string')
+    parser.add_argument('qbe', help='QBE object, as module:name')
+    parser.add_argument('names', nargs='*', help='helper names')
+    parser.add_argument('-m', '--maintenance-work-mem',
+                        help='maintenance_work_mem setting, like 1GB')
+    parser.add_argument('-l', '--lock-timeout',
+                        help='lock_timeout setting, like 10s')
+    parser.add_argument('-i', '--interval', type=float, default=10,
+                        help='seconds between progress reports')
+    parser.add_argument('-c', '--covering', action='store_true',
+                        help='include zoid in B-tree indexes')
+    options = parser.parse_args(args)
+
+    module, name = options.qbe.split(':')
+    qbe = getattr(importlib.import_module(module), name)
+
+    def progress(name, phase, blocks_done, blocks_total,
+                 tuples_done, tuples_total):
+        print('%s: %s, blocks %s/%s, tuples %s/%s' % (
+            name, phase, blocks_done, blocks_total,
+            tuples_done, tuples_total))
+        sys.stdout.flush()
+
+    for name, action in build(options.dsn, qbe, options.names,
+                              options.maintenance_work_mem,
+                              options.lock_timeout,
+                              progress, options.interval,
+                              options.covering):
+        print('%s %s' % (name, action))
@@ -0,0 +1,148 @@
+"""SQL literal quoting without a database connection
+
+The output is the same as that of psycopg2's `mogrify
+<http://initd.org/psycopg/docs/cursor.html#cursor.mogrify>`_ for the
+supported value types, assuming a UTF-8 database with
+``standard_conforming_strings`` on (the default since PostgreSQL 9.1).
+"""
+import datetime
+import math
+import re
+
+import psycopg2
+import six
+
+def _version(version):
+    return tuple(int(n) for n in re.match(r'\d+(\.\d+)*',
+                                          version).group().split('.'))
+
+# psycopg2 versions before 2.7.5 put spaces between array elements.
+array_separator = (b', ' if _version(psycopg2.__version__) < (2, 7, 5)
+                   else b',')
+
+def _number(text):
+    text = text.encode('ascii')
+    # psycopg2 puts a space in front of negative numbers
+    return b' ' + text if text.startswith(b'-') else text
+
+def _float(value):
+    if math.isnan(value):
+        return b"'NaN'::float"
+    if math.isinf(value):
+        return b"'Infinity'::float" if value > 0 else b"'-Infinity'::float"
+    return _number(repr(value))
+
+def _text(value):
+    if isinstance(value, six.text_type):
+        value = value.encode('utf-8')
+    if b'\0' in value:
+        raise ValueError(
+            "A string literal cannot contain NUL (0x00) characters.")
+    return b"'" + value.replace(b"'", b"''") + b"'"
+
+def _list(value):
+    if not value:
+        return b"'{}'"
+
+    quoted = []
+    all_nulls = True
+    for item in value:
+        q = quote(item)
+        if item is None:
+            pass
+        elif isinstance(item, list):
+            if q.startswith(b'A'):
+                all_nulls = False
+            elif q == b"'{}'":
+                all_nulls = False
+                q = b'ARRAY[]'
+        else:
+            all_nulls = False
+        quoted.append(q)
+
+    if all_nulls:
+        return (b"'{" +
+                array_separator.join(q.strip(b"'") for q in quoted) +
+                b"}'")
+
+    return b'ARRAY[' + array_separator.join(quoted) + b']'
+
+def _datetime(value):
+    if isinstance(value, datetime.datetime):
+        fmt = "'%s'::timestamp" if value.tzinfo is None else \
+              "'%s'::timestamptz"
+    elif isinstance(value, datetime.date):
+        fmt = "'%s'::date"
+    else:
+        fmt = "'%s'::time" if value.tzinfo is None else "'%s'::timetz"
+    return (fmt % value.isoformat()).encode('ascii')
+
+def interval(value):
+    """Return PostgreSQL interval text for a timedelta
+    """
+    return '%d days %d.%06d seconds' % (
+        value.days, value.seconds, value.microseconds)
+
+def _timedelta(value):
+    return ("'%s'::interval" % interval(value)).encode('ascii')
+
+def quote(value):
+    """Return an SQL literal for a value, as bytes
+
+    ``TypeError`` is raised for unsupported types.
+    """
+    if value is None:
+        return b'NULL'
+    if isinstance(value, bool):
+        return b'true' if value else b'false'
+    if isinstance(value, six.integer_types):
+        return _number(str(int(value)))
+    if isinstance(value, float):
+        return _float(value)
+    if isinstance(value, six.string_types):
+        return _text(value)
+    if isinstance(value, list):
+        return _list(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return _datetime(value)
+    if isinstance(value, datetime.timedelta):
+        return _timedelta(value)
+    if hasattr(value, 'getquoted'):
+        # Already adapted
+        return value.getquoted()
+    raise TypeError("Can't quote %r" % value)
+
+placeholder = re.compile(br'(%[%s])')
+
+def split(template):
+    """Split a template with ``%s`` placeholders into literal fragments
+
+    The template may contain ``%%`` for literal percent signs.  One
+    more fragment than there are placeholders is returned.
+    """
+    fragments = [b'']
+    for i, part in enumerate(placeholder.split(template)):
+        if i % 2 == 0:
+            fragments[-1] += part
+        elif part == b'%%':
+            fragments[-1] += b'%'
+        else:
+            fragments.append(b'')
+    return fragments
+
+def substitute(fragments, params):
+    """Substitute quoted parameters between compiled template fragments
+    """
+    if len(params) != len(fragments) - 1:
+        raise TypeError("Template expects %d parameters, but %d were given"
+                        % (len(fragments) - 1, len(params)))
+    result = [fragments[0]]
+    for param, fragment in zip(params, fragments[1:]):
+        result.append(quote(param))
+        result.append(fragment)
+    return b''.join(result)
+
+def mogrify(template, params=()):
+    """Substitute quoted parameters into a template with ``%s`` placeholders
+    """
+    return substitute(split(template), params)
@@ -0,0 +1,88 @@
+"""Execution of SQL as named prepared statements
+
+PostgreSQL parses and plans a prepared statement once per session, so
+executing the same SQL template repeatedly with different parameters
+avoids repeated parse and planning work.
+"""
+import itertools
+import threading
+import weakref
+
+from ._lru import LRU
+from .literal import placeholder
+
+def numbered(template):
+    """Convert a template with ``%s`` placeholders to one with ``$n``
+    """
+    n = itertools.count(1)
+    return placeholder.sub(
+        lambda m: (b'%' if m.group() == b'%%' else
+                   ('$%d' % next(n)).encode('ascii')),
+        template)
+
+class PreparedStatements(object):
+    """Bounded caches of prepared statements, one per database connection
+
+    Statements evicted from a cache are deallocated.
+    """
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._caches = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def _cache(self, connection):
+        with self._lock:
+            cache = self._caches.get(connection)
+            if cache is None:
+                cache = self._caches[connection] = _Statements(
+                    connection, self.maxsize)
+            return cache
+
+    def execute(self, cursor, statement, params=()):
+        """Execute an SQL statement with ``%s`` placeholders
+
+        The statement is prepared the first time it's executed on the
+        cursor's connection.
+        """
+        cache = self._cache(cursor.connection)
+        name = cache.get(statement)
+        if name is None:
+            name = cache.name()
+            cursor.execute(b'PREPARE ' + name + b' AS ' + numbered(statement))
+            cache[statement] = name
+
+        if params:
+            cursor.execute(
+                b'EXECUTE ' + name +
+                b' (' + b', '.join([b'%s'] * len(params)) + b')',
+                params)
+        else:
+            cursor.execute(b'EXECUTE ' + name)
+
+    def info(self, connection):
+        """Return cache statistics for a database connection
+        """
+        return self._cache(connection).info()
+
+class _Statements(LRU):
+
+    def __init__(self, connection, maxsize):
+        super(_Statements, self).__init__(maxsize, self._deallocate)
+        self._connection = weakref.ref(connection)
+        self._names = itertools.count()
+
+    def name(self):
+        return ('newt_qbe_%d' % next(self._names)).encode('ascii')
+
+    def _deallocate(self, statement, name):
+        connection = self._connection()
+        if connection is not None and not connection.closed:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(b'DEALLOCATE ' + name)
+            finally:
+                cursor.close()
+
+statements = PreparedStatements()
+execute = statements.execute
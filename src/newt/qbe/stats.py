@@ -0,0 +1,131 @@
+"""Recording query statistics for QBE objects
+
+A ``Recorder`` is a QBE observer that aggregates timings by query
+shape and samples slow queries.
+"""
+import bisect
+import collections
+import json
+import threading
+
+from timeit import default_timer as timer
+
+from .indexes import _savepoint
+
+# Histogram bucket upper bounds, in seconds
+bounds = (.001, .002, .005, .01, .02, .05, .1, .2, .5, 1, 2, 5, 10)
+
+Shape = collections.namedtuple('Shape', 'method names order_by')
+
+Slow = collections.namedtuple(
+    'Slow', 'shape template params build_time execute_time rows explain')
+
+class Stats(object):
+    """Counts, times and a latency histogram for a query shape
+
+    Histogram counts are for times up to the corresponding bound, with
+    a last count for longer times.
+    """
+
+    def __init__(self, bounds=bounds):
+        self.bounds = bounds
+        self.count = self.rows = 0
+        self.build_time = self.execute_time = self.max_time = 0.0
+        self.histogram = [0] * (len(bounds) + 1)
+        self.explained = None # When a query was last explained
+
+    def add(self, event):
+        seconds = event.build_time + (event.execute_time or 0)
+        self.count += 1
+        self.rows += event.rows or 0
+        self.build_time += event.build_time
+        self.execute_time += event.execute_time or 0
+        self.max_time = max(self.max_time, seconds)
+        self.histogram[bisect.bisect_left(self.bounds, seconds)] += 1
+
+    @property
+    def total_time(self):
+        return self.build_time + self.execute_time
+
+    def __repr__(self):
+        return '<Stats count=%d total_time=%.6f max_time=%.6f rows=%d>' % (
+            self.count, self.total_time, self.max_time, self.rows)
+
+class Recorder(object):
+    """Aggregate QBE query statistics by shape, in memory
+
+    Statistics are kept for at most ``maxshapes`` shapes, discarding
+    those seen least recently.  Queries that take at least
+    ``threshold`` seconds are kept in ``slow``, up to ``maxslow`` of
+    them.  If ``explain`` is true, they're sampled with ``EXPLAIN
+    (ANALYZE, BUFFERS)``, at most once per shape every
+    ``explain_interval`` seconds, since explaining a query runs it
+    again.
+    """
+
+    def __init__(self, threshold=1.0, maxshapes=1000, maxslow=100,
+                 explain=True, explain_interval=60, bounds=bounds):
+        self.threshold = threshold
+        self.maxshapes = maxshapes
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self.bounds = bounds
+        self.shapes = collections.OrderedDict()
+        self.slow = collections.deque(maxlen=maxslow)
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        shape = Shape(event.method, event.names, tuple(event.order_by))
+        slow = (event.execute_time is not None and
+                event.build_time + event.execute_time >= self.threshold)
+        sample = False
+        with self._lock:
+            stats = self.shapes.pop(shape, None)
+            if stats is None:
+                stats = Stats(self.bounds)
+            self.shapes[shape] = stats
+            while len(self.shapes) > self.maxshapes:
+                self.shapes.popitem(False)
+            stats.add(event)
+
+            if slow and self.explain and event.cursor is not None:
+                now = timer()
+                if (stats.explained is None or
+                    now - stats.explained >= self.explain_interval):
+                    stats.explained = now
+                    sample = True
+
+        if slow:
+            explain = None
+            if sample:
+                explain = _explain_analyze(
+                    event.cursor, event.template, event.params)
+            self.slow.append(Slow(shape, event.template, event.params,
+                                  event.build_time, event.execute_time,
+                                  event.rows, explain))
+
+    def report(self):
+        """Return shapes and statistics, by decreasing total time
+        """
+        with self._lock:
+            items = list(self.shapes.items())
+        return sorted(items, key=lambda item: -item[1].total_time)
+
+    def clear(self):
+        with self._lock:
+            self.shapes.clear()
+            self.slow.clear()
+
+def _explain_analyze(cursor, template, params):
+    if template.lstrip().upper().startswith(b'EXPLAIN'):
+        return None
+    with _savepoint(cursor):
+        try:
+            cursor.execute(b'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' +
+                           template, params)
+        except Exception:
+            return None # Sampling is best effort
+        [explain] = cursor.fetchone()
+    if not isinstance(explain, list):
+        explain = json.loads(explain)
+    return explain
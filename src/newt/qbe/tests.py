@@ -1,6 +1,7 @@
 import os
 import unittest
 import newt.db.tests.base
+from ZODB.utils import p64
 
 class QBETests(newt.db.tests.base.TestCase):
 
@@ -34,6 +35,32 @@ class QBETests(newt.db.tests.base.TestCase):
             b"""(state @> '{"x": 42}'::jsonb)""",
             self.qbe.sql(self.conn, dict(x='42')))
 
+    def test_match_merge(self):
+        from newt.qbe import match, scalar
+        self.qbe['type'] = match('type')
+        self.qbe['stars'] = match(('rating', 'stars'))
+        self.qbe['votes'] = match(('rating', 'votes'), convert=int)
+        self.qbe['tag'] = match('tags', member=True)
+        self.qbe['x'] = scalar('x')
+
+        self.assertEqual(
+            b"""(state @> '{"rating": {"stars": 5, "votes": 3},"""
+            b""" "tags": ["newt"], "type": "review"}'::jsonb) AND\n"""
+            b"""  ((state ->> 'x') = 'y')""",
+            self.qbe.sql(None, dict(type='review', stars=5, votes='3',
+                                    tag='newt', x='y')))
+        self.assertEqual(
+            b"""(state @> '{"tags": ["a", "b"]}'::jsonb)""",
+            self.qbe.sql(None, dict(tag=['a', 'b'])))
+
+        # Overlapping paths need separate conditions:
+        self.qbe['rating'] = match('rating')
+        self.assertEqual(
+            b"""(state @> '{"rating": {"n": 1}, "type": "review"}'::jsonb)"""
+            b""" AND\n  (state @> '{"rating": {"stars": 5}}'::jsonb)""",
+            self.qbe.sql(None, dict(rating=dict(n=1), stars=5,
+                                    type='review')))
+
     def test_scalar(self):
         from newt.qbe import scalar
         self.qbe['x'] = scalar('x')
@@ -274,7 +301,204 @@ class QBETests(newt.db.tests.base.TestCase):
                          )
             )
 
-    def test_integration(self):
+    def test_literal(self):
+        import datetime
+        from newt.qbe.literal import quote, mogrify
+        from psycopg2.extras import Json
+
+        class UTC(datetime.tzinfo):
+            def utcoffset(self, dt):
+                return datetime.timedelta(0)
+
+        conn = newt.db.pg_connection(self.dsn)
+        self.addCleanup(conn.close)
+        conn.set_client_encoding('UTF8')
+        cursor = conn.cursor()
+
+        for v in (None, True, False, 0, 42, -42, 2**70, 1.5, -1.5, 1e100,
+                  float('nan'), float('inf'), float('-inf'),
+                  'y', "it's", 'back\\slash', u'caf\xe9',
+                  '{"x": [1, "y"]}',
+                  [], ['a', 'b'], ['a', None], [None], [[None]], [[]],
+                  [['a']], [1, -2],
+                  datetime.date(2017, 6, 21),
+                  datetime.datetime(2017, 6, 21, 1, 2, 3),
+                  datetime.datetime(2017, 6, 21, 1, 2, 3, 4, UTC()),
+                  datetime.time(1, 2),
+                  datetime.timedelta(days=7),
+                  datetime.timedelta(hours=-3, microseconds=5),
+                  Json(dict(x=1)),
+                  ):
+            self.assertEqual(cursor.mogrify('%s', (v,)), quote(v))
+
+        self.assertRaises(TypeError, quote, object())
+        self.assertRaises(ValueError, quote, 'a\0')
+
+        self.assertEqual(b"x = 'a' and y like 'b%' || '%'",
+                         mogrify(b"x = %s and y like %s || '%%'", ('a', 'b%')))
+        self.assertRaises(TypeError, mogrify, b"%s", ())
+
+    def test_sql_without_connection(self):
+        from newt.qbe import match, scalar, sql
+
+        class custom(object):
+            def __call__(self, cursor, query):
+                return cursor.mogrify('custom(%s)', (query,))
+
+        self.qbe['m'] = match('m')
+        self.qbe['x'] = scalar('x', type='int')
+        self.qbe['u'] = sql('u(state) = %s')
+        self.qbe['z'] = custom()
+
+        self.assertEqual(
+            b"""(state @> '{"m": [1]}'::jsonb) AND\n"""
+            b"  ((state ->> 'x')::int >= 1)",
+            self.qbe.sql(None, dict(m=[1], x=(1, None))))
+
+        # Helpers without templates need a connection:
+        self.assertEqual(
+            b"((state ->> 'x')::int = 1) AND\n  custom('z')",
+            self.qbe.sql(self.conn, dict(x=1, z='z')))
+
+        # As does data that can only be quoted by the database driver:
+        self.assertEqual(b"u(state) = '\\x61'::bytea",
+                         self.qbe.sql(self.conn, dict(u=b'a')))
+        self.assertRaises(TypeError, self.qbe.sql, None, dict(u=b'a'))
+
+    def test_plan_cache(self):
+        from newt.qbe import scalar, sql
+
+        class custom(object):
+            def __call__(self, cursor, query):
+                return cursor.mogrify('custom(%s)', (query,))
+
+        self.qbe['x'] = scalar('x', type='int')
+        self.qbe['y'] = sql("y(state) = %s", 'y(state)')
+        self.qbe['z'] = custom()
+
+        self.assertEqual(
+            b"((state ->> 'x')::int = 1) AND\n  y(state) = 'a'",
+            self.qbe.sql(self.conn, dict(x=1, y='a')))
+        self.assertEqual(
+            b"((state ->> 'x')::int = 2) AND\n  y(state) = 'b'",
+            self.qbe.sql(self.conn, dict(x=2, y='b')))
+        self.assertEqual((1, 1, 100, 1), self.qbe.plan_cache_info())
+
+        # Different shapes use different plans:
+        self.assertEqual(
+            b"((state ->> 'x')::int <= 2) AND\n  y(state) = 'b'",
+            self.qbe.sql(self.conn, dict(x=(None, 2), y='b')))
+        self.assertEqual(
+            b"((state ->> 'x')::int <= 2)\nORDER BY y(state) DESC",
+            self.qbe.sql(self.conn, dict(x=(None, 2)),
+                         order_by=[('y', True)]))
+        self.assertEqual((1, 3, 100, 3), self.qbe.plan_cache_info())
+
+        # Helpers without templates are rendered with the cursor:
+        self.assertEqual(
+            b"((state ->> 'x')::int = 1) AND\n  custom('%')",
+            self.qbe.sql(self.conn, dict(x=1, z='%')))
+
+        # as are subclasses of built-in helpers overriding __call__ or
+        # order_by, but not the corresponding templates:
+        class lower(scalar):
+            def __call__(self, cursor, query):
+                return cursor.mogrify('lower(x) = lower(%s)', (query,))
+            def order_by(self, cursor, query):
+                return b'lower(x)'
+
+        self.qbe['l'] = lower('x')
+        self.assertEqual(
+            b"lower(x) = lower('A')\nORDER BY lower(x)",
+            self.qbe.sql(self.conn, dict(l='A'), ['l']))
+        del self.qbe['l']
+
+        # Replacing a helper doesn't reuse plans for the old one:
+        self.qbe['x'] = scalar('x')
+        self.assertEqual(
+            b"((state ->> 'x') = '1') AND\n  y(state) = 'a'",
+            self.qbe.sql(self.conn, dict(x='1', y='a')))
+
+        self.qbe.plan_cache_size = 2
+        self.qbe.sql(self.conn, dict(x='1'))
+        self.assertEqual(2, self.qbe.plan_cache_info().currsize)
+
+        self.qbe.plan_cache_clear()
+        self.assertEqual((0, 0, 2, 0), self.qbe.plan_cache_info())
+
+        # QBE objects can be pickled and copied, without their caches
+        # and observers, keeping their settings:
+        import copy, pickle
+        del self.qbe['z']
+        self.qbe.observers.append(lambda event: None)
+        self.qbe.hint('x', .1)
+        for qbe in (pickle.loads(pickle.dumps(self.qbe)),
+                    copy.deepcopy(self.qbe)):
+            self.assertEqual(sorted(self.qbe), sorted(qbe))
+            self.assertEqual(([], {'x': (.1, None)}, (0, 0, 2, 0)),
+                             (qbe.observers, qbe.hints, qbe.plan_cache_info()))
+            self.assertEqual(b"((state ->> 'x') = '2')",
+                             qbe.sql(None, dict(x='2')))
+
+        # including those pickled without attributes added later:
+        from newt.qbe import QBE
+        qbe = QBE.__new__(QBE)
+        qbe.update(self.qbe)
+        self.assertEqual(b"((state ->> 'x') = '3')",
+                         qbe.sql(None, dict(x='3')))
+
+    def test_old_helpers(self):
+        # Helpers unpickled with state saved by earlier versions work:
+        from newt.qbe import QBE, In, match, scalar, text_array
+
+        def old(helper, *names):
+            state = dict((name, value)
+                         for name, value in helper.__dict__.items()
+                         if name in names)
+            helper = helper.__class__.__new__(helper.__class__)
+            helper.__dict__.update(state)
+            return helper
+
+        qbe = QBE()
+        qbe['x'] = old(match('x'), 'name')
+        qbe['y'] = old(match('y'), 'name')
+        self.assertEqual(
+            b"""(state @> '{"x": 1, "y": 2}'::jsonb)""",
+            qbe.sql(None, dict(x=1, y=2)))
+
+        qbe['n'] = old(scalar('n', 'int'),
+                       'expr', '_range', '_eq', '_ge', '_le')
+        self.assertEqual(
+            b"((state ->> 'n')::int = ANY(ARRAY[1,2]))",
+            qbe.sql(None, In('n', [1, 2])))
+
+        qbe['tags'] = old(text_array('tags'), 'expr', '_any')
+        self.assertTrue(qbe['tags'].json)
+        self.assertFalse(text_array('tags(state)').json)
+
+    def test_sql_params(self):
+        from newt.qbe import scalar, prefix
+
+        class custom(object):
+            def __call__(self, cursor, query):
+                return cursor.mogrify('custom(%s)', (query,))
+
+        self.qbe['x'] = scalar('x', type='int')
+        self.qbe['p'] = prefix('p')
+        self.qbe['z'] = custom()
+
+        self.assertEqual(
+            (b"((state ->> 'p') like %s || '%%') AND\n"
+             b"  ((state ->> 'x')::int >= %s)",
+             ['/a', 1]),
+            self.qbe.sql_params(self.conn, dict(x=(1, None), p='/a')))
+
+        self.assertEqual(
+            (b"((state ->> 'x')::int = %s) AND\n  custom('%%')",
+             [1]),
+            self.qbe.sql_params(self.conn, dict(x=1, z='%')))
+
+    def populate(self):
         qbe = self.qbe
         from newt.qbe import scalar, text_array, prefix, fulltext, sql
         qbe['stars'] = scalar('stars', 'int')
@@ -317,6 +541,10 @@ class QBETests(newt.db.tests.base.TestCase):
                 ),
             )
         self.conn.commit()
+        return qbe
+
+    def test_integration(self):
+        qbe = self.populate()
         where = self.conn.where
 
 
@@ -359,6 +587,1054 @@ class QBETests(newt.db.tests.base.TestCase):
                                            order_by=['stars']))],
             )
 
+    def test_search(self):
+        from newt.qbe.prepared import statements, numbered
+        self.assertEqual(b"x = $1 and y like $2 || '%'",
+                         numbered(b"x = %s and y like %s || '%%'"))
+
+        qbe = self.populate()
+        self.assertEqual(
+            ['We have two newt reviews', 'newt uses ZODB'],
+            [o.text for o in qbe.search(self.conn,
+                                        dict(stars=(None, 4), path='/db'),
+                                        order_by=['stars'])],
+            )
+        self.assertEqual(
+            ['the best database is newt', 'newt uses ZODB'],
+            [o.text for o in qbe.search(self.conn,
+                                        dict(stars=(4, None), path='/db'),
+                                        order_by=[('stars', True)])],
+            )
+        self.assertEqual(
+            ['newt uses ZODB', 'the best database is newt'],
+            [o.text for o in qbe.search(self.conn, dict(ends='review'),
+                                        order_by=['stars'])],
+            )
+
+        from newt.db.search import read_only_cursor
+        cursor = read_only_cursor(self.conn)
+        connection = cursor.connection
+        cursor.close()
+        self.assertEqual(3, statements.info(connection).misses)
+
+        self.assertEqual(
+            ['We have two newt reviews'],
+            [o.text for o in qbe.search(self.conn,
+                                        dict(stars=(3, 3), path='/db'))],
+            )
+        self.assertEqual(
+            ['newt uses ZODB'],
+            [o.text for o in qbe.search(self.conn,
+                                        dict(stars=(4, 4), path='/db'))],
+            )
+        self.assertEqual((1, 4, 100, 4), statements.info(connection))
+
+        # SQL rendered with data, by helpers without templates, isn't
+        # prepared:
+        class custom(object):
+            def __call__(self, cursor, query):
+                return cursor.mogrify("state ->> 'path' = %s", (query,))
+
+        qbe['custom'] = custom()
+        for path in '/db/summary', '/news/friday':
+            self.assertEqual(
+                [path],
+                [o.path for o in qbe.search(self.conn, dict(custom=path))])
+        self.assertEqual((1, 4, 100, 4), statements.info(connection))
+
+        def prepared():
+            return self.conn.query_data(
+                "select count(*) from pg_prepared_statements"
+                " where name like 'newt_qbe_%%'")[0][0]
+
+        self.assertEqual(4, prepared())
+        statements._cache(connection).maxsize = 2
+        qbe.search(self.conn, dict(stars=5))
+        self.assertEqual(2, prepared())
+
+    def test_search_many(self):
+        qbe = self.populate()
+        queries = [dict(path='/db'), dict(stars=(None, 3)), dict(stars=9),
+                   dict(ends='review')]
+        self.assertEqual(
+            [['the best database is newt', 'newt uses ZODB',
+              'We have two newt reviews'],
+             ['We have two newt reviews', 'qbe is nearing release'],
+             [],
+             ['the best database is newt', 'newt uses ZODB']],
+            [[o.text for o in obs]
+             for obs in qbe.search_many(self.conn, queries,
+                                        [('stars', True)])])
+        self.assertEqual(
+            sorted(o.text for o in qbe.search(self.conn, queries[0])),
+            sorted(o.text for o in qbe.search_many(self.conn, queries)[0]))
+        self.assertEqual([], qbe.search_many(self.conn, []))
+
+        # Combined searches aren't prepared, only the single search was:
+        from newt.qbe.prepared import statements
+        self.assertEqual(1, statements.info(self.cursor.connection).currsize)
+
+    def test_page(self):
+        qbe = self.populate()
+
+        def texts(page):
+            objects, token = page
+            return [o.text for o in objects], token
+
+        def pages(query, order_by, size=2):
+            result = []
+            token = None
+            while True:
+                objects, token = texts(qbe.page(self.conn, query, order_by,
+                                                size=size, after=token))
+                result.append(objects)
+                if token is None:
+                    return result
+
+        self.assertEqual(
+            [['qbe is nearing release', 'We have two newt reviews'],
+             ['newt uses ZODB', 'the best database is newt']],
+            pages({}, ['stars']))
+        self.assertEqual(
+            [['the best database is newt', 'newt uses ZODB'],
+             ['We have two newt reviews']],
+            pages(dict(path='/db'), [('stars', True)]))
+        self.assertEqual(
+            [['We have two newt reviews'], ['newt uses ZODB'],
+             ['the best database is newt']],
+            pages(dict(path='/db'), [('path', True), 'stars'], 1))
+        # (Ranks are tied, so order among these depends on zoids.)
+        result = pages(dict(text='newt'), [('text', True)])
+        self.assertEqual([2, 1], [len(objects) for objects in result])
+        self.assertEqual(
+            ['We have two newt reviews', 'newt uses ZODB',
+             'the best database is newt'],
+            sorted(result[0] + result[1]))
+
+        objects, token = qbe.page(self.conn, {}, ['stars'], size=1)
+        self.assertRaises(ValueError, qbe.page, self.conn, {}, ['path'],
+                          after=token)
+        self.assertRaises(ValueError, qbe.page, self.conn, {}, ['stars'],
+                          after='nonsense')
+
+        # Seek predicates follow the ordering direction:
+        self.assertEqual(
+            b"select zoid, ghost_pickle, ((state ->> 'stars')::int)::text\n"
+            b"from newt\n"
+            b"where true AND\n"
+            b"  ((state ->> 'stars')::int, zoid) < (%s, %s)\n"
+            b"ORDER BY (state ->> 'stars')::int DESC,\n"
+            b"  zoid DESC\n"
+            b"LIMIT %s",
+            qbe._plan({}, [('stars', True)], 'page_after').template)
+        self.assertEqual(
+            b"(((state ->> 'path') || '/') < %s OR"
+            b" (((state ->> 'path') || '/') = %s AND"
+            b" ((state ->> 'stars')::int > %s OR"
+            b" ((state ->> 'stars')::int = %s AND zoid > %s))))",
+            qbe._plan({}, [('path', True), 'stars'], 'page_after'
+                      ).template.split(b'AND\n  ')[1].split(b'\n')[0])
+
+    def test_iter_search(self):
+        qbe = self.populate()
+        self.assertEqual(
+            ['qbe is nearing release', 'We have two newt reviews',
+             'newt uses ZODB'],
+            [o.text for o in qbe.iter_search(self.conn, dict(stars=(None, 4)),
+                                             order_by=['stars'],
+                                             batch_size=2)])
+
+        results = qbe.iter_search(self.conn, dict(path=''),
+                                  order_by=[('stars', True)], batch_size=1)
+        self.assertEqual('the best database is newt', next(results).text)
+
+        def cursors():
+            return self.conn.query_data(
+                "select count(*) from pg_cursors"
+                " where name like 'newt_qbe_iter_%%'")[0][0]
+
+        self.assertEqual(1, cursors())
+        results.close()
+        self.assertEqual(0, cursors())
+
+    def test_count(self):
+        qbe = self.populate()
+        self.assertEqual(3, qbe.count(self.conn, dict(path='/db')))
+        self.assertEqual(3, qbe.count(self.conn, dict(path='/db'),
+                                      mode='exact'))
+        self.assertEqual(2, qbe.count(self.conn, dict(path='/db'),
+                                      mode='capped', cap=2))
+        self.assertEqual(3, qbe.count(self.conn, dict(path='/db'),
+                                      mode='capped'))
+        estimate = qbe.count(self.conn, dict(path='/db'), mode='estimate')
+        self.assertTrue(isinstance(estimate, int))
+        self.assertTrue(estimate >= 1)
+        self.assertRaises(ValueError, qbe.count, self.conn, {}, 'guess')
+
+    def test_search_batch(self):
+        qbe = self.populate()
+        for cte in (False, True):
+            def batch(*args):
+                objects, total = qbe.search_batch(
+                    self.conn, dict(path='/db'), ['stars'], *args, cte=cte)
+                return [o.text for o in objects], total
+
+            self.assertEqual(
+                (['We have two newt reviews', 'newt uses ZODB'], 3),
+                batch(0, 2))
+            self.assertEqual((['the best database is newt'], 3),
+                             batch(2, 2))
+            self.assertEqual(([], 3), batch(4, 2))
+
+        self.assertEqual(
+            ([], 0), qbe.search_batch(self.conn, dict(path='/nothing')))
+
+    def test_result_cache(self):
+        qbe = self.populate()
+        qbe.result_cache_size = 10
+
+        def texts(query, order_by=('stars',)):
+            return [o.text for o in qbe.search(self.conn, query, order_by)]
+
+        expected = ['We have two newt reviews', 'newt uses ZODB',
+                    'the best database is newt']
+        self.assertEqual(expected, texts(dict(path='/db')))
+        self.assertEqual(expected, texts(dict(path='/db')))
+        self.assertEqual(expected[1:], texts(dict(path='/db', stars=(4, 5))))
+        obs, total = qbe.search_batch(
+            self.conn, dict(path='/db'), ['stars'], 1, 1)
+        self.assertEqual((['newt uses ZODB'], 3),
+                         ([o.text for o in obs], total))
+        info = qbe.result_cache_info()
+        self.assertEqual((1, 3, 0, 0, 10, 3), info[:6])
+        self.assertTrue(0 < info.currbytes <= info.maxbytes)
+
+        # Hits get objects using cached ghost pickles, without loading
+        # them:
+        self.conn._connection.cacheMinimize()
+        def get(oid):
+            raise AssertionError("loaded", oid)
+        self.conn.get = get
+        self.assertEqual(expected, texts(dict(path='/db')))
+        del self.conn.get
+        self.assertEqual(2, qbe.result_cache_info().hits)
+
+        # Committed changes invalidate cached results:
+        self.conn.root.content[0].path = '/news/newt_review'
+        self.conn.commit()
+        self.assertEqual(expected[:2], texts(dict(path='/db')))
+        self.assertEqual((2, 4, 0, 3, 10, 1), qbe.result_cache_info()[:6])
+
+        # Entries are evicted by count and size:
+        qbe.result_cache_size = 2
+        for stars in range(4):
+            texts(dict(stars=stars))
+        self.assertEqual(3, qbe.result_cache_info().evictions)
+        qbe.result_cache_bytes = 1
+        texts(dict(path='/db'))
+        info = qbe.result_cache_info()
+        self.assertEqual((0, 0), (info.currsize, info.currbytes))
+
+        qbe.result_cache_clear()
+        self.assertEqual((0, 0, 0, 0, 2, 0, 1, 0), qbe.result_cache_info())
+
+        # Caching is disabled by default:
+        qbe.result_cache_size = 0
+        texts(dict(path='/db'))
+        self.assertEqual((0, 0), qbe.result_cache_info()[:2])
+
+    def test_observers(self):
+        from newt.qbe.stats import Recorder, Shape
+        qbe = self.populate()
+        events = []
+        recorder = Recorder(threshold=0, maxshapes=2, maxslow=3)
+        qbe.observers.extend([events.append, recorder])
+
+        qbe.sql(None, dict(stars=5))
+        [event] = events
+        self.assertEqual(('sql', ('stars',), ()), event[:3])
+        self.assertEqual((None, None), (event.execute_time, event.rows))
+        self.assertTrue(event.build_time >= 0)
+
+        qbe.search(self.conn, dict(path='/db', stars=(4, None)), ['stars'])
+        qbe.search(self.conn, dict(path='/news', stars=(None, 4)), ['stars'])
+        qbe.count(self.conn, dict(path='/db'), 'estimate')
+        event = events[-2]
+        self.assertEqual(
+            ('search', ('path', 'stars'), (('stars', False),)), event[:3])
+        self.assertEqual(1, event.rows)
+        self.assertTrue(event.execute_time >= 0)
+
+        # Statistics are kept for the most recent shapes:
+        [(count, count_stats), (search, search_stats)] = sorted(
+            recorder.report())
+        self.assertEqual(Shape('count', ('path',), ()), count)
+        self.assertEqual(1, count_stats.count)
+        self.assertEqual(2, search_stats.count)
+        self.assertEqual(3, search_stats.rows)
+        self.assertEqual(2, sum(search_stats.histogram))
+
+        # Slow queries are explained, except for estimates, at most
+        # once per shape in explain_interval seconds:
+        slow, again, estimate = recorder.slow
+        self.assertEqual(search, slow.shape)
+        self.assertEqual(2, slow.rows)
+        self.assertTrue('Shared Hit Blocks' in slow.explain[0]['Plan'])
+        self.assertEqual((search, 1, None),
+                         (again.shape, again.rows, again.explain))
+        self.assertEqual(None, estimate.explain)
+
+        recorder.clear()
+        self.assertEqual(([], 0), (recorder.report(), len(recorder.slow)))
+
+    def test_advise(self):
+        from newt.qbe import match, scalar
+        qbe = self.populate()
+        qbe['email'] = scalar('email')
+        qbe['type'] = match('type')
+
+        # A prefix index needs the right operator class:
+        from contextlib import closing
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            conn.autocommit = True
+            with closing(conn.cursor()) as cursor:
+                cursor.execute("drop index newt_path_idx")
+                cursor.execute(
+                    "create index newt_path_idx on newt"
+                    " (((state ->> 'path') || '/'))")
+
+        advice = qbe.advise(self.conn)
+        self.assertEqual(['email', 'path'], advice.missing)
+        self.assertTrue('newt_stars_idx' in advice.unused)
+        self.assertEqual([], advice.seq_scans)
+
+        advice = qbe.advise(
+            self.conn,
+            [dict(stars=4), dict(ends='review'), (dict(text='newt'), ['stars']),
+             dict(email='jim@example.com', stars=4)],
+            enable_seqscan=False)
+        self.assertEqual([dict(ends='review')], advice.seq_scans)
+
+    def test_build_indexes(self):
+        qbe = self.populate()
+        from contextlib import closing
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            conn.autocommit = True
+            with closing(conn.cursor()) as cursor:
+                cursor.execute("drop index newt_path_idx")
+                # Simulate a failed concurrent build:
+                cursor.execute("""
+                update pg_index set indisvalid = false
+                where indexrelid = 'newt_stars_idx'::regclass
+                """)
+
+        self.assertEqual(
+            [('newt_path_idx', 'created'),
+             ('newt_stars_idx', 'rebuilt'),
+             ('newt_text_idx', 'exists')],
+            qbe.build_indexes(self.dsn, maintenance_work_mem='64MB',
+                              lock_timeout='10s',
+                              progress=lambda *row: None,
+                              interval=.001))
+        self.assertEqual(
+            [('newt_path_idx', 'exists')],
+            qbe.build_indexes(self.dsn, ['path']))
+
+        from newt.qbe.indexes import indexes
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            with closing(conn.cursor()) as cursor:
+                self.assertTrue(all(index.valid for index in indexes(cursor)))
+
+    def test_index_groups(self):
+        from newt.qbe import scalar
+        qbe = self.populate()
+        qbe['where'] = scalar('path')
+
+        self.assertEqual(
+            dict(where_stars_desc=[('where', False), ('stars', True)],
+                 stars_where=[('stars', False), ('where', False)],
+                 where_path=[('where', False), ('path', False)]),
+            qbe.infer_index_groups([
+                (dict(where='/db/summary'), [('stars', True)]),
+                (dict(where='/db/summary', stars=3), [('stars', True)]),
+                dict(where='/db', path='/db'),
+                dict(where='/db', text='newt'), # GIN
+                (dict(stars=3), ['text']),
+                ]))
+        self.assertEqual(
+            {}, qbe.infer_index_groups([dict(where='/db', path='/db')], 2))
+
+        with self.assertRaises(ValueError):
+            qbe.add_index_group('where_text', ['where', 'text'])
+        with self.assertRaises(ValueError):
+            qbe.add_index_group('stars', ['where', 'stars'])
+        qbe.add_index_group('where_stars', ['where', ('stars', True)])
+        self.assertEqual(
+            ["CREATE INDEX CONCURRENTLY newt_where_stars_idx ON newt"
+             " ((state ->> 'path'), ((state ->> 'stars')::int) DESC)"],
+            qbe.index_sql('where_stars'))
+        self.assertEqual(5, len(qbe.index_sql()))
+
+        # Conditions on group columns come first, in column order:
+        self.assertEqual(
+            b"((state ->> 'path') = '/db/summary') AND\n"
+            b"  ((state ->> 'stars')::int >= 3) AND\n"
+            b"  (((state ->> 'path') || '/') like '/db' || '/%')\n"
+            b"ORDER BY (state ->> 'stars')::int DESC",
+            qbe.sql(None, dict(path='/db', stars=(3, None),
+                               where='/db/summary'),
+                    order_by=[('stars', True)]))
+
+        qbe.build_indexes(self.dsn, ['where_stars'])
+        advice = qbe.advise(
+            self.conn, [(dict(where='/db/summary'), [('stars', True)])],
+            enable_seqscan=False)
+        self.assertEqual([], advice.seq_scans)
+        from contextlib import closing
+        from newt.qbe.indexes import _explain
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            with closing(conn.cursor()) as cursor:
+                cursor.execute("set enable_seqscan = off")
+                plan = _explain(cursor, *qbe._plan(
+                    dict(where='/db/summary'), [('stars', True)], 'search'
+                    ).render(None, dict(where='/db/summary')))
+        self.assertEqual('newt_where_stars_idx', plan['Index Name'])
+        self.assertEqual([ob.stars for ob in qbe.search(
+            self.conn, dict(where='/db/summary'), [('stars', True)])], [3])
+
+    def test_scope(self):
+        from newt.qbe import scalar, prefix
+        qbe = self.populate()
+        scope = "state ->> 'path' like '/db/%'"
+        qbe['dbstars'] = scalar('stars', 'int', scope=scope)
+        qbe['dbpath'] = prefix('path', scope=scope)
+
+        self.assertEqual(
+            ["CREATE INDEX CONCURRENTLY newt_dbpath_idx"
+             " ON newt ((state ->> 'path') text_pattern_ops)"
+             " WHERE state ->> 'path' like '/db/%'",
+             "CREATE INDEX CONCURRENTLY newt_dbstars_idx"
+             " ON newt (((state ->> 'stars')::int))"
+             " WHERE state ->> 'path' like '/db/%'"],
+            qbe.index_sql('dbpath', 'dbstars'))
+
+        self.assertEqual(
+            [('newt_dbstars_idx', 'created')],
+            qbe.build_indexes(self.dsn, ['dbstars']))
+
+        # The scope is included once, for conditions and ordering:
+        self.assertEqual(
+            b"(state ->> 'path' like '/db/%') AND\n"
+            b"  ((state ->> 'path') like '/db/n' || '%') AND\n"
+            b"  ((state ->> 'stars')::int >= 3)",
+            qbe.sql(None, dict(dbstars=(3, None), dbpath='/db/n')))
+        self.assertEqual(
+            b"(state ->> 'path' like '/db/%') AND\n"
+            b"  ((state ->> 'stars')::int >= 3)\n"
+            b"ORDER BY (state ->> 'path')",
+            qbe.sql(None, dict(stars=(3, None)), ['dbpath']))
+
+        self.assertEqual(
+            [5, 4, 3],
+            [ob.stars for ob in qbe.search(
+                self.conn, dict(dbstars=(2, None)), [('dbstars', True)])])
+
+        # In query trees, scopes are combined with the conditions of
+        # scoped helpers, so negations and alternatives can match
+        # objects outside the scope:
+        from newt.qbe import Not, Or
+        self.assertEqual(
+            b"NOT ((state ->> 'path' like '/db/%') AND"
+            b" ((state ->> 'stars')::int = 4))",
+            qbe.sql(None, Not(dict(dbstars=4))))
+        self.assertEqual(
+            [5, 3, 2],
+            [ob.stars for ob in qbe.search(
+                self.conn, Not(dict(dbstars=4)), [('stars', True)])])
+        self.assertEqual(
+            b"(((state ->> 'path' like '/db/%') AND"
+            b" ((state ->> 'stars')::int = 4)) OR\n"
+            b"   (((state ->> 'path') || '/') like '/news' || '/%'))",
+            qbe.sql(None, Or(dict(dbstars=4), dict(path='/news'))))
+        self.assertEqual(
+            [4, 2],
+            [ob.stars for ob in qbe.search(
+                self.conn, Or(dict(dbstars=4), dict(path='/news')),
+                [('stars', True)])])
+
+        self.assertEqual(['dbpath'], qbe.advise(self.conn).missing)
+
+        from newt.qbe.indexes import _explain
+        from contextlib import closing
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            with closing(conn.cursor()) as cursor:
+                cursor.execute("set enable_seqscan = off")
+                plan = _explain(cursor, *qbe._plan(
+                    dict(dbstars=4), (), 'search').render(
+                        None, dict(dbstars=4)))
+        self.assertEqual('newt_dbstars_idx', plan['Index Name'])
+
+    def test_query_tree(self):
+        from newt.qbe import And, Or, Not, In, match
+        qbe = self.populate()
+        qbe['type'] = match('type')
+        qbe['stars'].convert = int
+
+        self.assertEqual(
+            b"((state ->> 'stars')::int = ANY(ARRAY[3,5]))",
+            qbe.sql(None, In('stars', ['3', 5])))
+        self.assertEqual(
+            b"""((state @> '{"type": "a"}'::jsonb) OR\n"""
+            b"""   (state @> '{"type": "b"}'::jsonb))""",
+            qbe.sql(None, In('type', ['a', 'b'])))
+        self.assertEqual(
+            b"((((state ->> 'path') || '/') like '/news' || '/%') OR\n"
+            b"   (((state ->> 'stars')::int >= 4) AND"
+            b" NOT (((state ->> 'path') || '/') like '/db/newt_review'"
+            b" || '/%')))\n"
+            b"ORDER BY (state ->> 'stars')::int",
+            qbe.sql(None,
+                    Or(dict(path='/news'),
+                       And(dict(stars=(4, None)),
+                           Not(dict(path='/db/newt_review')))),
+                    ['stars']))
+
+        # Criteria are merged and ranges collapsed:
+        self.assertEqual(
+            b"(((state ->> 'path') || '/') like '/db' || '/%') AND\n"
+            b"  (((state ->> 'stars')::int >= 3) and"
+            b" ((state ->> 'stars')::int <= 4))",
+            qbe.sql(None, And(dict(stars=(2, 4)), dict(path='/db'),
+                              And(dict(stars=(3, None))))))
+
+        # Bounds are compared after conversion, and left alone if they
+        # can't be compared:
+        from newt.qbe import scalar
+        qbe['n'] = scalar('n', 'int', convert=int)
+        self.assertEqual(
+            b"((state ->> 'n')::int >= 10)",
+            qbe.sql(None, And(dict(n=('9', None)), dict(n=('10', None)))))
+        self.assertEqual(
+            b"((state ->> 'stars')::int >= 4)",
+            qbe.sql(None, And(dict(stars=('3', None)), dict(stars=(4, None)))))
+        qbe['m'] = scalar('m', 'int')
+        self.assertEqual(
+            b"((state ->> 'm')::int >= '3') AND\n"
+            b"  ((state ->> 'm')::int >= 4)",
+            qbe.sql(None, And(dict(m=('3', None)), dict(m=(4, None)))))
+
+        def stars(query, order_by=('stars',)):
+            return [ob.stars for ob in qbe.search(self.conn, query, order_by)]
+
+        self.assertEqual([2, 4], stars(
+            Or(dict(path='/news'),
+               And(dict(stars=(4, None)), Not(dict(path='/db/newt_review'))))))
+        self.assertEqual([3, 5], stars(In('stars', [3, 5, 7])))
+        self.assertEqual([4, 5], stars(And(In('stars', [3, 4, 5]),
+                                           dict(text='newt'),
+                                           dict(stars=(4, None)))))
+        self.assertEqual([5], stars(And(dict(stars=(2, 5)),
+                                        dict(stars=(5, 6)))))
+        self.assertEqual(
+            2, qbe.count(self.conn, Or(dict(stars=2), dict(stars=3))))
+        self.assertEqual(
+            ([4, 3], 4),
+            (lambda r: ([ob.stars for ob in r[0]], r[1]))(qbe.search_batch(
+                self.conn, Or(dict(path='/db'), dict(stars=2)),
+                [('stars', True)], 1, 2)))
+
+        # Trees with the same shape share plans:
+        qbe.plan_cache_clear()
+        qbe.sql(None, Or(dict(stars=1), Not(In('stars', [1, 2]))))
+        qbe.sql(None, Or(dict(stars=2), Not(In('stars', [2, 3, 4]))))
+        self.assertEqual((1, 1), qbe.plan_cache_info()[:2])
+
+        self.assertRaises(TypeError, qbe.sql, None, Or(['stars']))
+
+    def test_hints(self):
+        from newt.qbe import match
+        qbe = self.populate()
+        qbe['type'] = match('type')
+        query = dict(ends='review', path='/db', stars=3, type='x')
+        self.assertEqual(
+            b"state ->> 'path' like '%' || 'review' AND\n"
+            b"  (((state ->> 'path') || '/') like '/db' || '/%') AND\n"
+            b"  ((state ->> 'stars')::int = 3) AND\n"
+            b"""  (state @> '{"type": "x"}'::jsonb)""",
+            qbe.sql(None, query))
+
+        # Expensive conditions last, selective ones first:
+        qbe.hint('ends', cost=100)
+        qbe.hint('stars', selectivity=.01)
+        self.assertEqual(
+            b"((state ->> 'stars')::int = 3) AND\n"
+            b"  (((state ->> 'path') || '/') like '/db' || '/%') AND\n"
+            b"""  (state @> '{"type": "x"}'::jsonb) AND\n"""
+            b"  state ->> 'path' like '%' || 'review'",
+            qbe.sql(None, query))
+        self.assertRaises(KeyError, qbe.hint, 'nope', .1)
+
+        estimates = qbe.estimate_selectivity(
+            self.conn, dict(stars=3, path='/db'))
+        self.assertEqual(['path', 'stars'], sorted(estimates))
+        self.assertTrue(all(0 <= e <= 1 for e in estimates.values()))
+        self.assertEqual((estimates['stars'], None), qbe.hints['stars'])
+        self.assertEqual((None, 100), qbe.hints['ends'])
+
+    def test_stored_fulltext(self):
+        from newt.qbe import fulltext
+        qbe = self.populate()
+        qbe['stored'] = fulltext('text', 'english', column='text_vector')
+
+        self.assertEqual(
+            b"text_vector @@ to_tsquery('english', 'newt')\n"
+            b"ORDER BY ts_rank_cd(array[0.1, 0.2, 0.4, 1], text_vector,"
+            b" to_tsquery('english', 'newt'))",
+            qbe.sql(None, dict(stored='newt'), ['stored']))
+        self.assertEqual(
+            ["CREATE INDEX CONCURRENTLY newt_stored_idx"
+             " ON newt USING GIN (text_vector)"],
+            qbe.index_sql('stored'))
+        self.assertEqual([], qbe.column_sql('text'))
+
+        from contextlib import closing
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            conn.autocommit = True
+            with closing(conn.cursor()) as cursor:
+                for sql in qbe.column_sql():
+                    cursor.execute(sql)
+                for sql in qbe.column_sql(): # Again, idempotently
+                    cursor.execute(sql)
+
+        progress = []
+        self.assertEqual(
+            dict(stored=5), # Including the root
+            qbe.backfill(self.dsn, batch_size=4,
+                         progress=lambda *a: progress.append(a)))
+        self.assertEqual([('stored', 4), ('stored', 5)], progress)
+        qbe.build_indexes(self.dsn, ['stored'])
+
+        # New data are indexed by a trigger:
+        from newt.db import Object
+        self.conn.root.more = Object(text='newts are amphibians')
+        self.conn.commit()
+
+        def texts(name, query='newt'):
+            return [ob.text for ob in qbe.search(
+                self.conn, {name: query}, [(name, True), 'stars'])]
+
+        self.assertEqual(texts('text'), texts('stored'))
+        self.assertEqual(4, len(texts('stored')))
+        self.assertEqual(['newt uses ZODB'], texts('stored', 'zodb'))
+        self.assertEqual([], qbe.advise(self.conn).missing)
+
+    def test_covering_indexes(self):
+        from newt.qbe import scalar
+        qbe = self.populate()
+        qbe['rating'] = scalar('stars', 'int', column='rating')
+        qbe['scoped'] = scalar('stars', 'int', scope="state ? 'path'")
+        qbe.add_index_group('path_stars', ['path', 'stars'])
+
+        self.assertEqual(
+            ["CREATE INDEX CONCURRENTLY newt_path_stars_idx ON newt"
+             " (((state ->> 'path') || '/') text_pattern_ops,"
+             " ((state ->> 'stars')::int)) INCLUDE (zoid)",
+             "CREATE INDEX CONCURRENTLY newt_rating_idx ON newt (rating)"
+             " INCLUDE (zoid)",
+             "CREATE INDEX CONCURRENTLY newt_scoped_idx ON newt"
+             " (((state ->> 'stars')::int)) INCLUDE (zoid)"
+             " WHERE state ? 'path'",
+             "CREATE INDEX CONCURRENTLY newt_text_idx ON newt USING GIN"
+             " (to_tsvector('english', state ->> 'text'))"],
+            qbe.index_sql('path_stars', 'rating', 'scoped', 'text',
+                          covering=True))
+        self.assertRaises(TypeError, qbe.index_sql, include=True)
+        self.assertEqual(
+            "ALTER TABLE newt ADD COLUMN IF NOT EXISTS rating int",
+            qbe['rating'].column_sql()[0])
+        self.assertEqual(
+            b"select zoid from newt where (rating >= %s)\nORDER BY rating",
+            qbe._plan(dict(rating=(4, None)), ['rating'], 'zoids').template)
+
+        from contextlib import closing
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            conn.autocommit = True
+            with closing(conn.cursor()) as cursor:
+                for sql in qbe.column_sql():
+                    cursor.execute(sql)
+        qbe.backfill(self.dsn)
+        self.assertEqual([('newt_rating_idx', 'created')],
+                         qbe.build_indexes(self.dsn, ['rating'],
+                                           covering=True))
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            conn.autocommit = True
+            with closing(conn.cursor()) as cursor:
+                cursor.execute('VACUUM ANALYZE newt')
+
+        root = self.conn.root
+        zoids = [ob._p_oid for ob in root.content]
+        self.assertEqual(
+            [zoids[1], zoids[0]],
+            [p64(z) for z in qbe.search_zoids(
+                self.conn, dict(rating=(4, None)), ['rating'])])
+        self.assertEqual(
+            [ob._p_oid for ob in qbe.search(
+                self.conn, dict(path='/db'), ['stars'])],
+            [p64(z) for z in qbe.search_zoids(
+                self.conn, dict(path='/db'), ['stars'])])
+
+        query = dict(rating=(4, None))
+        template, params = qbe._plan(query, ['rating'], 'zoids').render(
+            None, query)
+        self.cursor.execute('SET LOCAL enable_seqscan = off')
+        self.cursor.execute(b'EXPLAIN ' + template, params)
+        plan = '\n'.join(row[0] for row in self.cursor.fetchall())
+        self.assertTrue('Index Only Scan' in plan, plan)
+
+    def test_path(self):
+        from newt.qbe import path
+        qbe = self.populate()
+        qbe['tree'] = path('path', 'path_ancestors')
+
+        self.assertEqual(
+            b"(path_ancestors @> ARRAY['/db'] AND"
+            b" cardinality(path_ancestors) = 2)",
+            qbe.sql(None, dict(tree=dict(under='/db/', depth=1))))
+        self.assertEqual(
+            ["CREATE INDEX CONCURRENTLY newt_tree_idx"
+             " ON newt USING GIN (path_ancestors)"],
+            qbe.index_sql('tree'))
+        self.assertRaises(ValueError, qbe.sql, None,
+                          dict(tree=dict(depth=1)))
+
+        from contextlib import closing
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            conn.autocommit = True
+            with closing(conn.cursor()) as cursor:
+                for sql in qbe.column_sql('tree'):
+                    cursor.execute(sql)
+        self.assertEqual(dict(tree=5), qbe.backfill(self.dsn))
+        qbe.build_indexes(self.dsn, ['tree'])
+
+        from newt.db import Object
+        self.conn.root.more = (
+            Object(path='/db', text='databases'),
+            Object(path='/db/newt_review/comments/1', text='first!'),
+            )
+        self.conn.commit()
+
+        def texts(query):
+            return sorted(ob.text for ob in qbe.search(
+                self.conn, dict(tree=query)))
+
+        # Subtrees are the same as for prefix helpers:
+        for query in '/db', '/db/newt_review', '', '/d':
+            self.assertEqual(texts(query), sorted(
+                ob.text for ob in qbe.search(self.conn, dict(path=query))))
+        self.assertEqual(6, len(texts('/')))
+
+        self.assertEqual(['We have two newt reviews', 'newt uses ZODB',
+                          'the best database is newt'],
+                         texts(dict(under='/db', depth=1)))
+        self.assertEqual(['databases'], texts(dict(under='/', depth=1)))
+        self.assertEqual(['first!'],
+                         texts(dict(under='/db/newt_review', depth=2)))
+        self.assertEqual(
+            ['databases', 'the best database is newt'],
+            texts(dict(ancestors='/db/newt_review/comments/1')))
+        self.assertEqual([], texts(dict(ancestors='/db')))
+        self.assertEqual([], qbe.advise(self.conn).missing)
+
+    def test_span(self):
+        import datetime
+        from newt.qbe import span
+        qbe = self.populate()
+        qbe['when'] = span('created', 'timestamptz', bucket='day')
+        qbe['rating'] = span('stars', 'int', index='brin', bucket=2)
+
+        self.assertEqual(
+            b"((state ->> 'created')::timestamptz >="
+            b" now() - '7 days 0.000000 seconds'::interval)",
+            qbe.sql(None, dict(when=datetime.timedelta(days=7))))
+        self.assertEqual(
+            b"(((state ->> 'stars')::int >= 3) and"
+            b" ((state ->> 'stars')::int < 5))\n"
+            b"ORDER BY (state ->> 'stars')::int",
+            qbe.sql(None, dict(rating=(3, 5)), ['rating']))
+        self.assertEqual(
+            ["CREATE INDEX CONCURRENTLY newt_rating_idx"
+             " ON newt USING BRIN (((state ->> 'stars')::int))"],
+            qbe.index_sql('rating'))
+        self.assertRaises(ValueError, span, 'x', index='hash')
+
+        # Times can only be indexed if they're stored in columns:
+        self.assertRaises(ValueError, qbe.index_sql, 'when')
+        self.assertEqual([], [sql for sql in qbe.index_sql() if 'when' in sql])
+        self.assertEqual(
+            "CREATE INDEX CONCURRENTLY newt_when_idx ON newt (created)",
+            span('created', 'timestamptz', column='created'
+                 ).index_sql('when'))
+        self.assertEqual([('newt_rating_idx', 'created')],
+                         qbe.build_indexes(self.dsn, ['rating']))
+        self.assertFalse('when' in qbe.advise(self.conn).missing)
+
+        now = datetime.datetime.utcnow()
+        for ob, days in zip(self.conn.root.content, (1, 3, 10, 40)):
+            ob.created = (now - datetime.timedelta(days=days)
+                          ).isoformat() + '+00:00'
+        self.conn.commit()
+
+        def texts(query, order_by=('stars',)):
+            return [ob.text for ob in qbe.search(self.conn, query, order_by)]
+
+        self.assertEqual(
+            ['newt uses ZODB', 'the best database is newt'],
+            texts(dict(when=datetime.timedelta(days=7))))
+        self.assertEqual(
+            ['We have two newt reviews', 'newt uses ZODB'],
+            texts(dict(when=(datetime.timedelta(days=30),
+                             datetime.timedelta(days=2)))))
+
+        # Ranges are half-open:
+        self.assertEqual(['We have two newt reviews', 'newt uses ZODB'],
+                         texts(dict(rating=(3, 5))))
+        self.assertEqual(['qbe is nearing release'],
+                         texts(dict(rating=(None, 3))))
+        self.assertEqual(['newt uses ZODB'], texts(dict(rating=4)))
+
+        # Ordering uses exact values and facets use buckets:
+        self.assertEqual(
+            ['the best database is newt', 'newt uses ZODB',
+             'We have two newt reviews', 'qbe is nearing release'],
+            texts(dict(rating=(2, None)), [('rating', True), 'stars']))
+        self.assertEqual(dict(rating={2: 2, 4: 2}),
+                         qbe.facets(self.conn, dict(path=''), ['rating']))
+        self.assertEqual(
+            [1, 1, 1, 1],
+            list(qbe.facets(self.conn, dict(path=''), ['when'])['when'
+                                                               ].values()))
+
+    def test_top(self):
+        qbe = self.populate()
+        query = dict(text='newt | zodb')
+
+        self.assertEqual(
+            b"select zoid, ghost_pickle, count(*) over ()\n"
+            b"from (select * from newt where"
+            b" to_tsvector('english', state ->> 'text')"
+            b" @@ to_tsquery('english', %s)\n"
+            b"ORDER BY (state ->> 'stars')::int DESC\n"
+            b"      LIMIT %s) candidates\n"
+            b"ORDER BY ts_rank_cd(array[0.1, 0.2, 0.4, 1],"
+            b" to_tsvector('english', state ->> 'text'),"
+            b" to_tsquery('english', %s)) DESC\n"
+            b"LIMIT %s",
+            qbe._plan(query, [('stars', True), ('text', True)],
+                      ('top', 1)).template)
+
+        def texts(obs):
+            return [ob.text for ob in obs]
+
+        full = texts(qbe.search(self.conn, query, [('text', True), 'stars']))
+        obs, info = qbe.top(self.conn, query, [('text', True), 'stars'], 2)
+        self.assertEqual(full[:2], texts(obs))
+        self.assertEqual((3, 1000, False), info)
+
+        # Only rank the best-rated matches:
+        obs, info = qbe.top(self.conn, query, [('text', True)],
+                            candidates=2, proxy=[('stars', True)])
+        self.assertEqual((2, 2, True), info)
+        self.assertEqual(['newt uses ZODB', 'the best database is newt'],
+                         texts(obs))
+
+        obs, info = qbe.top(self.conn, dict(text='nothing'), ['text'])
+        self.assertEqual(([], (0, 1000, False)), (obs, info))
+
+    def test_trigram(self):
+        from newt.qbe import trigram
+        qbe = self.populate()
+        qbe['in_path'] = trigram('path')
+        qbe['like_text'] = trigram('text', similar=True, index='gist')
+        self.assertRaises(ValueError, trigram, 'path', index='btree')
+
+        self.assertEqual(
+            b"((state ->> 'path') ilike '%\\_review%') AND\n"
+            b"  ((state ->> 'text') % 'newts')\n"
+            b"ORDER BY (state ->> 'text') <-> 'newts'",
+            qbe.sql(None, dict(in_path='_review', like_text='newts'),
+                    ['like_text']))
+        self.assertEqual(
+            b"((state ->> 'path') ilike '%50\\%\\_\\\\%')",
+            qbe.sql(None, dict(in_path='50%_\\')))
+        self.assertEqual(
+            ["CREATE INDEX CONCURRENTLY newt_in_path_idx"
+             " ON newt USING GIN ((state ->> 'path') gin_trgm_ops)",
+             "CREATE INDEX CONCURRENTLY newt_like_text_idx"
+             " ON newt USING GIST ((state ->> 'text') gist_trgm_ops)"],
+            qbe.index_sql('in_path', 'like_text'))
+
+        self.assertEqual(
+            ['/db/newt_review', '/db/secret_review'],
+            [ob.path for ob in qbe.search(
+                self.conn, dict(in_path='REVIEW'), ['path'])])
+        self.assertEqual(
+            [], qbe.search(self.conn, dict(in_path='db_newt')))
+
+    def test_trigram_index(self):
+        from contextlib import closing
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            conn.autocommit = True
+            with closing(conn.cursor()) as cursor:
+                cursor.execute("select 1 from pg_available_extensions"
+                               " where name = 'pg_trgm'")
+                if not cursor.fetchall():
+                    self.skipTest("pg_trgm isn't available")
+                cursor.execute("create extension if not exists pg_trgm")
+
+        from newt.qbe import trigram
+        qbe = self.populate()
+        qbe['like_text'] = trigram('text', similar=True, index='gist')
+        qbe.build_indexes(self.dsn, ['like_text'])
+
+        self.assertEqual(
+            ['newt uses ZODB'],
+            [ob.text for ob in qbe.page(self.conn, dict(like_text='newt uses'),
+                                        ['like_text'], 1)[0]])
+
+        from newt.qbe.indexes import _explain
+        with closing(newt.db.pg_connection(self.dsn)) as conn:
+            with closing(conn.cursor()) as cursor:
+                cursor.execute("set enable_seqscan = off")
+                plan = _explain(cursor, *qbe._plan(
+                    {}, ['like_text'], 'page').render(
+                        None, dict(like_text='newt'), [5]))
+        self.assertEqual('Limit', plan['Node Type'])
+        self.assertEqual('newt_like_text_idx',
+                         plan['Plans'][0].get('Index Name'))
+
+    def test_facets(self):
+        from newt.qbe import text_array, Or
+        qbe = self.populate()
+        qbe['tags'] = text_array('tags')
+        for ob, tags in zip(self.conn.root.content,
+                            (['a', 'b'], ['b'], ['b', 'c'], 'd')):
+            ob.tags = tags
+        self.conn.commit()
+
+        facets = ['stars', 'tags', ('stars', [3, 5])]
+        self.assertEqual(
+            dict(stars={2: 1, 3: 1, 4: 1, 5: 1, None: 1},
+                 tags=dict(a=1, b=3, c=1)),
+            qbe.facets(self.conn, {}, facets[:2]))
+
+        # Facet conditions don't apply to their own counts:
+        self.assertEqual(
+            dict(stars={3: 1, 4: 1, 5: 1},
+                 tags=dict(a=1, b=2)),
+            qbe.facets(self.conn, dict(path='/db', stars=(4, None)),
+                       facets[:2]))
+        self.assertEqual(
+            dict(stars={4: 1, 5: 1},
+                 tags=dict(a=1, b=2)),
+            qbe.facets(self.conn, dict(path='/db', stars=(4, None)),
+                       facets[:2], exclude_own=False))
+
+        self.assertEqual(
+            dict(stars={(None, 3): 1, (3, 5): 2, (5, None): 1}),
+            qbe.facets(self.conn, dict(path=''), [facets[2]]))
+
+        self.assertEqual(
+            dict(stars={2: 1, 5: 1}),
+            qbe.facets(self.conn, Or(dict(stars=2), dict(stars=5)),
+                       ['stars']))
+        self.assertRaises(ValueError, qbe.facets, self.conn, {}, ['text'])
+        self.assertRaises(ValueError, qbe.facets, self.conn, {},
+                          ['stars', ('stars', [3, 5])])
+
+    def test_benchmark(self):
+        from newt.qbe import benchmark
+        self.populate()
+        [[count]] = self.conn.query_data("select count(*) from public.newt")
+        messages = []
+        results = benchmark.run(self.dsn, rows=300, repeat=2, iterations=10,
+                                batch_size=200, progress=messages.append)
+        self.assertEqual(['generated 200 rows', 'generated 300 rows'],
+                         messages[:2])
+        names = sorted(name for name, _, _ in benchmark.cases)
+        for key in 'build', 'without_indexes', 'with_indexes':
+            self.assertEqual(names, sorted(results[key]))
+        self.assertEqual(['sql', 'sql_params'],
+                         sorted(results['build']['match']))
+        for name in names:
+            # Indexes don't change results:
+            self.assertEqual(results['without_indexes'][name]['rows'],
+                             results['with_indexes'][name]['rows'])
+        self.assertTrue(results['with_indexes']['match']['rows'] > 0)
+        self.assertTrue('newt_text_idx' in results['index_build'])
+        self.assertEqual(
+            [], self.conn.query_data(
+                "select 1 from pg_namespace"
+                " where nspname = 'newt_qbe_benchmark'"))
+        # The Newt DB table in the public schema is left alone:
+        self.assertEqual(
+            [(count,)],
+            self.conn.query_data("select count(*) from public.newt"))
+
+        # Existing schemas aren't used or dropped:
+        self.assertRaises(ValueError, benchmark.run, self.dsn, rows=10,
+                          schema='public')
+        self.assertEqual(
+            [(count,)],
+            self.conn.query_data("select count(*) from public.newt"))
+
+    def test_aio(self):
+        import sys
+        if sys.version_info < (3, 5):
+            self.skipTest("asyncio searches need Python 3.5")
+        import asyncio
+        from newt.qbe import aio
+        qbe = self.populate()
+        query = dict(path='/db')
+        pool = aio.Pool(self.dsn, 3)
+
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            rows = loop.run_until_complete(
+                aio.search(qbe, pool, query, ['stars']))
+            self.assertEqual(
+                ['We have two newt reviews', 'newt uses ZODB',
+                 'the best database is newt'],
+                [o.text for o in aio.load(self.conn, rows)])
+
+            # Counts, pages and facets can be computed concurrently:
+            (total, (rows, token), facets) = loop.run_until_complete(
+                asyncio.gather(
+                    aio.count(qbe, pool, query),
+                    aio.page(qbe, pool, query, ['stars'], 2),
+                    aio.facets(qbe, pool, query, ['stars'])))
+            self.assertEqual(3, total)
+            self.assertEqual(['We have two newt reviews', 'newt uses ZODB'],
+                             [o.text for o in aio.load(self.conn, rows)])
+            self.assertEqual(dict(stars={3: 1, 4: 1, 5: 1}), facets)
+            self.assertEqual(3, len(pool._free))
+
+            rows, token = loop.run_until_complete(
+                aio.page(qbe, pool, query, ['stars'], 2, token))
+            self.assertEqual(['the best database is newt'],
+                             [o.text for o in aio.load(self.conn, rows)])
+            self.assertEqual(None, token)
+
+            # Connections can also be used directly:
+            conn = loop.run_until_complete(aio.connect(self.dsn))
+            self.assertEqual(1, loop.run_until_complete(
+                aio.count(qbe, conn, dict(stars=5), 'capped')))
+            conn.close()
+        finally:
+            pool.close()
+            asyncio.set_event_loop(None)
+            loop.close()
+
 def crazy_parse(q):
     return 'CRAZY ' + q
 